@@ -2,7 +2,7 @@ from .version import __version__, __version_info__
 
 from .decorators import connect
 from .signals import log
-from .actions import save_queue, track, untrack
+from .actions import save_queue, log_many, track, untrack
 from .handler import ActionHandler
 
 from . import level
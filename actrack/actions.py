@@ -9,6 +9,7 @@ from .handler import ActionHandlerMetaclass
 from .actions_queue import thread_actions_queue
 from .signals import log as log_action
 from .helpers import to_set
+from .cache import feed_cache
 
 
 def create_action(verb, **kwargs):
@@ -16,8 +17,6 @@ def create_action(verb, **kwargs):
     Creates an action
     """
 
-    from .models import GM2M_ATTRS
-
     # removes the 'signal' keyword in kwargs so that it is not taken into
     # account in the action's data
     kwargs.pop('signal', None)
@@ -25,20 +24,41 @@ def create_action(verb, **kwargs):
     # the actor is the sender
     kwargs['actor'] = kwargs.pop('sender', None)
 
+    kwargs['verb'] = verb
+    add_action(kwargs)
+
+
+def add_action(kwargs, handler_classes=None):
+    """
+    Normalizes the kwargs describing an action and adds it to the queue,
+    unless it is combined with a queued action. The handler classes already
+    resolved may be provided as a {verb: handler class} dictionary
+    """
+
+    from .models import GM2M_ATTRS
+
     # default timestamp
     kwargs.setdefault('timestamp', now())
 
+    verb = kwargs['verb']
     try:
         # Try and retrieve untranslated verb if applicable
         verb = verb._proxy__args[0]
     except (AttributeError, IndexError):
         pass
-    kwargs['verb'] = str(verb)
+    kwargs['verb'] = verb = str(verb)
 
     for attr in GM2M_ATTRS:
         kwargs[attr] = to_set(kwargs.pop(attr, None))
 
-    handler_class = ActionHandlerMetaclass.handler_class(verb)
+    if handler_classes is None:
+        handler_class = ActionHandlerMetaclass.handler_class(verb)
+    else:
+        try:
+            handler_class = handler_classes[verb]
+        except KeyError:
+            handler_class = handler_classes[verb] = \
+                ActionHandlerMetaclass.handler_class(verb)
 
     kwargs.setdefault('level', handler_class.level)
 
@@ -57,10 +77,56 @@ def create_action(verb, **kwargs):
     thread_actions_queue.add(handler_class, kwargs)
 
 
+def log_many(actions):
+    """
+    Logs several actions at once, without sending the log_action signal for
+    each of them. The actions are combined and grouped the same way as the
+    actions logged with ``log``.
+
+    :param actions: an iterable of dictionaries, each with an 'actor' and a
+                    'verb' key and the other keyword arguments ``log`` accepts
+    """
+    handler_classes = {}
+    for kwargs in actions:
+        kwargs = dict(kwargs)
+        kwargs.setdefault('actor', None)
+        add_action(kwargs, handler_classes)
+
+
 def save_queue(sender=None, **kwargs):
     thread_actions_queue.save()
 
 
+async def asave_queue(sender=None, **kwargs):
+    await thread_actions_queue.asave()
+
+
+def reset_queue(sender=None, **kwargs):
+    """
+    Starts a new queue when an ASGI request starts, as the asyncio task
+    handling the request may share its queue with the task that created it
+    """
+    from .models import DeletedItem
+    if 'scope' in kwargs:
+        thread_actions_queue.reset()
+        DeletedItem.registry.reset()
+
+
+def save_queue_on_exit(sender=None, **kwargs):
+    if not thread_actions_queue.check_commit_hooks():
+        thread_actions_queue.save(background=True)
+
+
+def start_unread_cache(sender=None, **kwargs):
+    from .models import UnreadTracker
+    UnreadTracker.cache.start()
+
+
+def clear_unread_cache(sender=None, **kwargs):
+    from .models import UnreadTracker
+    UnreadTracker.cache.reset()
+
+
 def track(user, to_track, log=False, **kwargs):
     """
     Enables a user to track objects or change his tracking options for these
@@ -73,7 +139,7 @@ def track(user, to_track, log=False, **kwargs):
                                the actor?
     """
 
-    from .models import Tracker
+    from .models import Tracker, InboxEntry
     from .gfk import get_content_type, get_pk
 
     # convert to_track and verbs to sets
@@ -108,6 +174,7 @@ def track(user, to_track, log=False, **kwargs):
     tracked_objs = []
 
     # modify existing matching trackers if needed
+    to_backfill = []
     for tracker in trackers:
         changed = []
         for k, v in kwargs.items():
@@ -117,6 +184,7 @@ def track(user, to_track, log=False, **kwargs):
 
         if changed:
             tracker.save()
+            to_backfill.append(tracker)
 
         tracked_objs.append(tracker.tracked)
 
@@ -127,10 +195,21 @@ def track(user, to_track, log=False, **kwargs):
     # create trackers to untracked objects
     untracked_objs = to_track.difference(tracked_objs)
     for obj in untracked_objs:
-        trackers.append(Tracker.objects.db_manager(db)
-                                       .create(user=user,
-                                               tracked=obj,
-                                               **kwargs))
+        tracker = Tracker.objects.db_manager(db).create(user=user,
+                                                        tracked=obj,
+                                                        **kwargs)
+        trackers.append(tracker)
+        to_backfill.append(tracker)
+
+    # update the user's inbox
+    if len(to_backfill) > len(untracked_objs):
+        # some trackers may follow less actions than before
+        InboxEntry.prune(user, db)
+    InboxEntry.backfill(Tracker.objects.db_manager(db)
+                               .filter(pk__in=[t.pk for t in to_backfill]))
+    if to_backfill:
+        feed_cache.invalidate(db, [user.pk])
+
     if log and untracked_objs:
         log_action(user, verb=_('started tracking'), targets=untracked_objs)
 
@@ -144,7 +223,7 @@ def untrack(user, to_untrack, verbs=None, log=False, using=None):
     :param log: should an action be logged if a tracker is deleted?
     """
 
-    from .models import Tracker
+    from .models import Tracker, InboxEntry
     from .gfk import get_content_type
 
     # convert to_track and verbs to sets
@@ -171,11 +250,13 @@ def untrack(user, to_untrack, verbs=None, log=False, using=None):
 
     verbs = to_set(verbs)
     untracked_objs = []
+    uncrowded = []
     if not len(verbs):
         # all verbs should be untracked, just mass-delete the tracker objects
         if log:
             # retrieve the untracked objects beforehand
             untracked_objs.extend(t.tracked for t in trackers)
+        uncrowded = InboxEntry.uncrowded_by(trackers)
         trackers.delete()
     else:
         # only some verbs should be untracked
@@ -192,12 +273,18 @@ def untrack(user, to_untrack, verbs=None, log=False, using=None):
             # delete trackers with no more verbs to follow
             if log:
                 untracked_objs.extend(t.tracked for t in to_untrack)
-            Tracker.objects.db_manager(db).filter(id__in=set(to_untrack)) \
-                                          .delete()
+            untracked = Tracker.objects.db_manager(db) \
+                                       .filter(id__in=set(to_untrack))
+            uncrowded = InboxEntry.uncrowded_by(untracked)
+            untracked.delete()
         if to_update:
             # update trackers which still have verbs to follow
             Tracker.objects.db_manager(db).filter(id__in=set(to_untrack)) \
                                           .update(verbs=verbs)
 
+    InboxEntry.prune(user, db)
+    InboxEntry.uncrowd(uncrowded, db)
+    feed_cache.invalidate(db, [user.pk])
+
     if untracked_objs:  # no need to check for log
         log_action(user, verb=_('stopped tracking'), targets=untracked_objs)
@@ -1,15 +1,89 @@
-from threading import local
+import atexit
+import logging
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+
+from django.db import connections, close_old_connections, transaction
+from django.db.models import Q
 
 from .helpers import to_set
+from .cache import feed_cache
+from .local import RequestLocal, sync_to_async
+from .settings import SAVE_WORKERS, SAVE_WORKERS_BACKLOG, SAVE_ON_COMMIT, \
+    QUEUE_MAX_SIZE, QUEUE_MAX_AGE
+
 
+logger = logging.getLogger('actrack')
 
-class ThreadActionsQueue(local):
+
+def mk_through_objs(action, attr, elts):
     """
-    An object to store the actions that were created in this thread, actually
-    during this request
+    Returns the through model of the gm2m attribute attr and a list of its
+    instances linking action to the elements of elts, deleted instances being
+    replaced by their DeletedItem
     """
-    def __init__(self):
+
+    # avoids circular imports
+    from .models import Action, DeletedItem
+    from .gfk import get_content_type
+
+    through = getattr(Action, attr).through
+    objs = []
+    for elt in elts:
+        if elt.pk is None:
+            # this is a deleted item, attempt to retrieve the DeletedItem
+            # instance from the registry
+            try:
+                elt = DeletedItem.registry[elt]
+            except KeyError:
+                continue
+        objs.append(through(
+            gm2m_src=action,
+            gm2m_ct=get_content_type(elt),
+            gm2m_pk=elt.pk
+        ))
+    return through, objs
+
+
+def actor_key(actor):
+    """
+    Returns a hashable key, that is the same for equal actors
+    """
+    try:
+        pk = actor.pk
+    except AttributeError:
+        return actor
+    if pk is None:
+        # unsaved instances are only equal to themselves
+        return id(actor)
+    return actor._meta.concrete_model, pk
+
+
+class ThreadActionsQueue(RequestLocal):
+    """
+    An object to store the actions that were created during this request, in
+    this thread or, when running under ASGI, in this asyncio task
+    """
+    def initialize(self):
         self.registry = []
+        # the registry entries by actor, and then by verb and by verb they can
+        # be combined with, to find the entries a new action can be combined
+        # with. The entries are stored along with a sequence number
+        self.index = {}
+        self.seq = 0
+        # when the first action of the registry was added
+        self.started = None
+        # the last commit hook registered for each database, and the hooks of
+        # the transactions in which the queued entries have been logged, by
+        # entry id
+        self.commit_hooks = {}
+        self.tagged = {}
+        # are the commit hooks being run?
+        self.committing = False
 
     def __iter__(self):
         return iter(self.registry)
@@ -21,72 +95,825 @@ class ThreadActionsQueue(local):
         return self.registry[n]
 
     def __delitem__(self, n):
-        del self.registry[n]
+        self.remove(self.registry[n])
 
     def add(self, handler_class, kwargs):
-        self.registry.append((handler_class, kwargs))
+        if self.started is None:
+            self.started = monotonic()
+        entry = (handler_class, kwargs)
+        self.registry.append(entry)
+        self._index(entry)
+        if SAVE_ON_COMMIT:
+            self._add_commit_hook(entry)
 
-    def save(self):
+        # the entries waiting for their transaction to commit cannot be saved
+        if QUEUE_MAX_SIZE \
+        and len(self.registry) - len(self.tagged) >= QUEUE_MAX_SIZE \
+        or QUEUE_MAX_AGE and monotonic() - self.started >= QUEUE_MAX_AGE:
+            # the queue is too big or too old, save it now to release memory
+            queue_stats.add_auto_save()
+            self.save()
+
+    def _index(self, entry):
+        handler_class, kwargs = entry
+        self.seq += 1
+        item = (self.seq, entry)
+        by_verb, by_combinator = self.index.setdefault(
+            actor_key(kwargs.get('actor', None)), ({}, {})
+        )
+        by_verb.setdefault(kwargs['verb'], []).append(item)
+        for verb in handler_class._combinators:
+            by_combinator.setdefault(verb, []).append(item)
+
+    def remove(self, entry):
+        """
+        Removes an entry (a (handler_class, kwargs) tuple) from the queue
+        """
+        self._remove_from(self.registry, lambda e: e is entry)
+        self.tagged.pop(id(entry), None)
+
+        handler_class, kwargs = entry
+        by_verb, by_combinator = \
+            self.index[actor_key(kwargs.get('actor', None))]
+        for items in [by_verb[kwargs['verb']]] + \
+                     [by_combinator[v] for v in handler_class._combinators]:
+            self._remove_from(items, lambda item: item[1] is entry)
+
+    @staticmethod
+    def _remove_from(l, match):
+        for i, e in enumerate(l):
+            if match(e):
+                del l[i]
+                return
+
+    def combination_candidates(self, handler_class, kwargs):
+        """
+        Returns the queued entries that the action described by kwargs may be
+        combined with, i.e. the entries with the same actor for which
+        handler_class defines a combinator or which handler class defines a
+        combinator for kwargs' verb, the most recent first
+        """
+
+        try:
+            by_verb, by_combinator = \
+                self.index[actor_key(kwargs.get('actor', None))]
+        except KeyError:
+            return []
+
+        items = dict(by_combinator.get(kwargs['verb'], ()))
+        for verb in handler_class._combinators:
+            items.update(by_verb.get(verb, ()))
+
+        return [items[seq] for seq in sorted(items, reverse=True)]
+
+    def _add_commit_hook(self, entry):
+        """
+        Tags a queued entry with a hook that saves the queue when the
+        transaction (or savepoint) in which the entry has been logged commits.
+        Only one hook is registered per database and savepoint
+        """
+
+        handler_class, kwargs = entry
+        try:
+            db = kwargs.get('using', None) or self._get_db(kwargs)
+        except RuntimeError:
+            # the queue will be saved at the end of the request
+            return
+
+        if not transaction.get_connection(db).in_atomic_block:
+            return
+
+        hook = self.commit_hooks.get(db, None)
+        if hook is None or not hook.is_current():
+            # a savepoint may have been rolled back since the last hook was
+            # registered
+            self._discard_rolled_back()
+            hook = self.commit_hooks[db] = CommitHook(db)
+        self.tagged[id(entry)] = hook
+
+    def _discard_rolled_back(self):
+        """
+        Discards the entries logged in transactions or savepoints that have
+        been rolled back. Must not be called while the commit hooks are run
+        """
+        for entry in list(self.registry):
+            hook = self.tagged.get(id(entry), None)
+            if hook is not None and not hook.committed \
+            and not hook.is_pending():
+                self.remove(entry)
+
+    def _on_commit(self):
+        self.committing = True
+        try:
+            self.save(background=True)
+        finally:
+            self.committing = False
+
+    def check_commit_hooks(self):
+        """
+        Checks the status of the registered commit hooks
+
+        :return: ``True`` if the queue will be saved when a transaction that is
+                 still in progress commits
+        """
+        return any(hook.is_pending() for hook in self.tagged.values())
+
+    def _hold(self):
+        """
+        Removes the entries logged in transactions that have not committed
+        from the registry. The entries logged in transactions that have been
+        rolled back are discarded
+
+        :return: the (entry, hook) tuples of the entries to put back in the
+                 registry once it is saved
+        """
+
+        if not self.tagged:
+            return []
+
+        ready = []
+        held = []
+        for entry in self.registry:
+            hook = self.tagged.get(id(entry), None)
+            if hook is None or hook.committed:
+                ready.append(entry)
+            elif self.committing or hook.is_pending():
+                # while the commit hooks are run, the hooks that have not
+                # been run yet are not pending anymore
+                held.append((entry, hook))
+
+        self.registry = ready
+        self.tagged = {}
+        return held
+
+    @staticmethod
+    def _held_deleted_items(held):
+        """
+        Returns the (instance, deleted item) tuples of the deleted items
+        registry that the held entries refer to, as the registry is flushed
+        when the queue is saved
+        """
+
+        from .models import DeletedItem, GM2M_ATTRS
+
+        if not held:
+            return []
+
+        elts = []
+        for (hdlr_class, kwargs), hook in held:
+            elts.append(kwargs.get('actor', None))
+            for attr in GM2M_ATTRS:
+                elts.extend(kwargs.get(attr, None) or ())
+        # deleted instances have no pk, and are compared by identity
+        return [item for item in DeletedItem.registry
+                if any(item[0] is elt for elt in elts)]
+
+    def _restore(self, held, del_items=()):
+        """
+        Puts back the entries returned by ``_hold`` in the registry, and the
+        deleted items they refer to in the deleted items registry
+        """
+
+        from .models import DeletedItem
+
+        for instance, del_item in del_items:
+            try:
+                DeletedItem.registry[instance]
+            except KeyError:
+                DeletedItem.registry.add(instance, del_item)
+
+        for entry, hook in held:
+            if self.started is None:
+                self.started = monotonic()
+            self.registry.append(entry)
+            self._index(entry)
+            self.tagged[id(entry)] = hook
+
+    def save(self, background=False):
         """
         Save all actions in the queue in database
+
+        :param background: if ``True`` and ``SAVE_WORKERS`` is set, the queue
+                           is handed over to a worker thread and saved there,
+                           unless all the workers are busy
         """
 
+        held = self._hold()
+        del_items = self._held_deleted_items(held)
+        try:
+            self._save(background)
+        finally:
+            self._restore(held, del_items)
+
+    def _save(self, background):
+
+        if background and SAVE_WORKERS and self.registry \
+        and actions_saver.submit(self):
+            return
+
+        size = len(self.registry)
+        start = monotonic()
+
         # avoids circular imports
-        from .models import Action, DeletedItem, GM2M_ATTRS
+        from .models import Action, UnreadTracker, InboxEntry, GM2M_ATTRS
+
+        # the actions to create, per database, in the order in which they are
+        # popped from the registry
+        to_create = defaultdict(lambda: [])
+
+        # the queued actions an action can be grouped with have the same verb,
+        # actor and database, and precede it in the queue. They are gathered
+        # in buckets that are consumed from the end as the queue is popped
+        buckets = {}
+        entry_buckets = []
+        for hdlr_class, kwargs in self.registry:
+            bucket = buckets.setdefault(
+                (kwargs['verb'], actor_key(kwargs.get('actor', None)),
+                 kwargs.get('using', None)),
+                GroupingBucket()
+            )
+            actor = kwargs.get('actor', None)
+            bucket.append(kwargs, actor and hdlr_class._fingerprints(
+                actor, kwargs['verb'], kwargs
+            ))
+            entry_buckets.append(bucket)
+
+        # the saved actions the queued actions may be grouped with
+        db_candidates = DBGroupingCandidates(self.registry)
 
         while self.registry:
             hdlr_class, kwargs = self.registry.pop()
-            if hdlr_class._group(kwargs) is True:
+            bucket = entry_buckets.pop()
+            bucket.pop()
+            if hdlr_class._group(kwargs, bucket, db_candidates) is True:
                 # the action has been merged with other ones, it won't be saved
                 continue
 
-            db = kwargs.pop('using', None)
-            if not db:
-                for o in {kwargs.get('actor', None)} | \
-                         kwargs.get('targets', set()) | \
-                         kwargs.get('related', set()):
-                    try:
-                        db = o._state.db
-                        break
-                    except AttributeError:
-                        pass
-                else:
-                    # cannot deduct database, raise error
-                    raise RuntimeError(
-                        'Cannot deduct database from owner, targets or '
-                        'related objects. Please use the "using" keyword to '
-                        'provide a database. Action arguments:\n%s' %
-                        repr(kwargs),
-                    )
+            db = kwargs.pop('using', None) or self._get_db(kwargs)
 
             gm2ms = {attr: to_set(kwargs.pop(attr, None))
                      for attr in GM2M_ATTRS}
 
-            # TODO: use bulk_create
-            action = Action.objects.db_manager(db).create(**kwargs)
+            to_create[db].append((Action(**kwargs), gm2ms))
 
-            for attr in GM2M_ATTRS:
-                l = gm2ms[attr]
-                if not isinstance(l, (tuple, list, set)):
-                    l = [l]  # convert to a sequence
-                elts = []
-                for elt in set(l).union(getattr(action, attr).all()):
-                    if elt.pk is None:
-                        # this is a deleted item, attempt to retrieve the
-                        # DeletedItem instance from the registry
-                        try:
-                            elt = DeletedItem.registry[elt]
-                        except KeyError:
-                            continue
-                    elts.append(elt)
-                setattr(action, attr, elts)
+        db_candidates.save()
+
+        saved = 0
+        for db, actions in to_create.items():
+            with transaction.atomic(using=db):
+                self._bulk_save(db, actions)
+                UnreadTracker.fan_out(actions, db)
+                InboxEntry.fan_out(actions, db)
+            feed_cache.invalidate_actions(actions, db)
+            saved += len(actions)
 
         self.flush()
 
+        if size:
+            queue_stats.add_save(size, saved, monotonic() - start)
+
+    async def asave(self):
+        """
+        Asynchronous version of ``save``, to be awaited from asyncio code
+        """
+        if sync_to_async is None:
+            raise RuntimeError('Saving the actions queue asynchronously '
+                               'requires asgiref.')
+        await sync_to_async(self.save)()
+
+    @staticmethod
+    def _get_db(kwargs):
+        """
+        Deducts the database to use from the actor, targets or related objects
+        of the action described by kwargs
+        """
+        for o in {kwargs.get('actor', None)} | \
+                 kwargs.get('targets', set()) | \
+                 kwargs.get('related', set()):
+            try:
+                return o._state.db
+            except AttributeError:
+                pass
+
+        # cannot deduct database, raise error
+        raise RuntimeError(
+            'Cannot deduct database from owner, targets or related objects. '
+            'Please use the "using" keyword to provide a database. Action '
+            'arguments:\n%s' % repr(kwargs),
+        )
+
+    @staticmethod
+    def _bulk_save(db, actions):
+        """
+        Inserts Action instances and their targets and related objects in the
+        database db, using as few queries as possible
+
+        :param actions: a list of (Action instance, gm2ms dict) tuples
+        """
+
+        # avoids circular imports
+        from .models import Action, GM2M_ATTRS
+
+        instances = []
+        for action, gm2ms in actions:
+            action.set_fingerprints(*[gm2ms[attr] for attr in GM2M_ATTRS])
+            instances.append(action)
+
+        if connections[db].features.can_return_rows_from_bulk_insert:
+            Action.objects.db_manager(db).bulk_create(instances)
+        else:
+            # the primary keys would not be set by bulk_create, and they are
+            # needed to create the through model instances
+            for action in instances:
+                action.save(force_insert=True, using=db)
+
+        through_objs = defaultdict(lambda: [])
+        for action, gm2ms in actions:
+            for attr in GM2M_ATTRS:
+                through, objs = mk_through_objs(action, attr, gm2ms[attr])
+                through_objs[through].extend(objs)
+
+        for through, objs in through_objs.items():
+            through._default_manager.using(db).bulk_create(objs)
+
     def flush(self):
         from .models import DeletedItem
         self.registry = []
+        self.index = {}
+        self.started = None
+        self.tagged = {}
         DeletedItem.registry.flush()
 
 
+class CommitHook(object):
+    """
+    A hook registered in a transaction with ``transaction.on_commit``, which
+    the queued entries logged in this transaction are tagged with. If the
+    transaction or savepoint in which the hook has been registered is rolled
+    back, the hook is discarded and so are the entries
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.savepoint_ids = list(transaction.get_connection(db)
+                                             .savepoint_ids)
+        self.committed = False
+        transaction.on_commit(self, using=db)
+
+    def __call__(self):
+        self.committed = True
+        thread_actions_queue._on_commit()
+
+    def is_pending(self):
+        """
+        Is the hook registered in a transaction in progress?
+        """
+        if self.committed:
+            return False
+        connection = transaction.get_connection(self.db)
+        # django discards the hooks of the transactions and savepoints that
+        # are rolled back. The items of run_on_commit are (savepoint ids,
+        # function) tuples, with an extra ``robust`` flag from django 4.2
+        return connection.in_atomic_block and \
+            any(hook[1] is self for hook in connection.run_on_commit)
+
+    def is_current(self):
+        """
+        Can the entries logged now be tagged with this hook?
+        """
+        connection = transaction.get_connection(self.db)
+        return self.savepoint_ids == connection.savepoint_ids and \
+            self.is_pending()
+
+
+class GroupingBucket(object):
+    """
+    Queued actions sharing the same verb, actor and database, in the queue
+    order
+
+    When the handler uses the default ``group`` implementation, the entries
+    are also indexed by the fingerprints of their targets and related objects,
+    so that the ones an action may be grouped with are looked up rather than
+    scanned
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.timestamps = []
+        # are the timestamps in the same order as the entries?
+        self.ordered = True
+        # the entries per fingerprint, as {position: entry} dicts, and the
+        # position and fingerprints of each entry (None when an entry has no
+        # fingerprints, in which case the index cannot be used)
+        self.by_fingerprint = defaultdict(dict)
+        self.indexed = {}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, kwargs, fingerprints=None):
+        tstamp = kwargs['timestamp']
+        if self.timestamps and tstamp < self.timestamps[-1]:
+            self.ordered = False
+        if self.indexed is not None:
+            if fingerprints is None:
+                self.indexed = None
+                self.by_fingerprint.clear()
+            else:
+                self._index(len(self.entries), kwargs, fingerprints)
+        self.entries.append(kwargs)
+        self.timestamps.append(tstamp)
+
+    def pop(self):
+        self.timestamps.pop()
+        kwargs = self.entries.pop()
+        if self.indexed is not None:
+            self._unindex(kwargs)
+        return kwargs
+
+    def _index(self, position, kwargs, fingerprints):
+        # the targets and related fingerprints are kept apart, as an action
+        # may be grouped with another one when either of them matches
+        keys = tuple(enumerate(fingerprints))
+        for key in keys:
+            self.by_fingerprint[key][position] = kwargs
+        self.indexed[id(kwargs)] = (position, keys)
+
+    def _unindex(self, kwargs):
+        position, keys = self.indexed.pop(id(kwargs))
+        for key in keys:
+            entries = self.by_fingerprint[key]
+            del entries[position]
+            if not entries:
+                del self.by_fingerprint[key]
+        return position
+
+    def reindex(self, kwargs, fingerprints):
+        """
+        Updates the fingerprints of an entry which targets or related objects
+        have changed
+        """
+        if self.indexed is not None and id(kwargs) in self.indexed:
+            self._index(self._unindex(kwargs), kwargs, fingerprints)
+
+    def window(self, from_tstamp, to_tstamp):
+        """
+        Returns the entries which timestamps are between from_tstamp and
+        to_tstamp, in the queue order (or a superset of them if the
+        timestamps are not ordered)
+        """
+        if not self.ordered:
+            return self.entries
+        return self.entries[bisect_left(self.timestamps, from_tstamp):
+                            bisect_right(self.timestamps, to_tstamp)]
+
+    def matching(self, fingerprints):
+        """
+        Returns the entries which targets or related objects have the same
+        fingerprint as the given ones, in the queue order, or None if the
+        entries are not indexed
+        """
+        if self.indexed is None or fingerprints is None:
+            return None
+        found = {}
+        for key in enumerate(fingerprints):
+            found.update(self.by_fingerprint.get(key, {}))
+        return [found[position] for position in sorted(found)]
+
+
+class DBGroupingCandidates(object):
+    """
+    The saved actions that queued actions may be grouped with, retrieved with
+    one query per database, and the changes made to them by grouping, that are
+    saved in bulk
+    """
+
+    #: the maximum number of (actor, verb) pairs in one query
+    batch_size = 200
+
+    def __init__(self, registry):
+
+        # the largest time window for each database, actor and verb, and the
+        # fingerprints of the targets and related objects of the queued
+        # actions (None if the saved actions cannot be filtered on them)
+        self.windows = {}
+        self.fingerprints = {}
+        for hdlr_class, kwargs in registry:
+            window = hdlr_class._grouping_window(kwargs)
+            actor = kwargs.get('actor', None)
+            if window is None or actor is None:
+                continue
+            key = self._key(actor, kwargs['verb'])
+            try:
+                from_tstamp, to_tstamp = self.windows[key]
+                self.windows[key] = (min(from_tstamp, window[0]),
+                                     max(to_tstamp, window[1]))
+            except KeyError:
+                self.windows[key] = window
+                self.fingerprints[key] = (set(), set())
+
+            fingerprints = hdlr_class._fingerprints(actor, kwargs['verb'],
+                                                    kwargs)
+            if fingerprints is None:
+                self.fingerprints[key] = None
+            elif self.fingerprints[key] is not None:
+                for fps, fp in zip(self.fingerprints[key], fingerprints):
+                    fps.add(fp)
+
+        # the candidate actions for each database, actor and verb, the most
+        # recent first
+        self.actions = defaultdict(lambda: [])
+        self.fetched = defaultdict(lambda: set())
+        keys_by_db = defaultdict(lambda: [])
+        for key in self.windows:
+            keys_by_db[key[0]].append(key)
+        for db, keys in keys_by_db.items():
+            for i in range(0, len(keys), self.batch_size):
+                self._fetch(db, [(key, self.fingerprints[key])
+                                 for key in keys[i:i + self.batch_size]])
+
+        # the grouped actions by database, and their targets and related
+        # objects
+        self.changed = defaultdict(lambda: {})
+        self.sets = {}
+
+    @staticmethod
+    def _key(actor, verb):
+        from .gfk import get_content_type
+        return (actor._state.db, get_content_type(actor).pk, str(actor.pk),
+                verb)
+
+    def _fetch(self, db, keys):
+        """
+        Retrieves the candidate actions in the database db for a list of
+        (key, fingerprints) tuples
+        """
+
+        # avoids circular imports
+        from .models import Action, GM2M_ATTRS
+
+        q = Q()
+        for key, fingerprints in keys:
+            __, ct, pk, verb = key
+            from_tstamp, to_tstamp = self.windows[key]
+            q_key = Q(actor_ct=ct, actor_pk=pk, verb=verb,
+                      timestamp__gte=from_tstamp, timestamp__lte=to_tstamp)
+            if fingerprints is not None:
+                # actions saved without fingerprints are candidates as well
+                q_key &= Q(targets_hash__in=fingerprints[0]) | \
+                         Q(related_hash__in=fingerprints[1]) | \
+                         Q(targets_hash=None)
+            q |= q_key
+
+        qs = Action.objects.db_manager(db).prefetch_related(*GM2M_ATTRS)
+        fetched = self.fetched[db]
+        if fetched:
+            qs = qs.exclude(pk__in=fetched)
+
+        updated = set()
+        for action in qs.filter(q):
+            fetched.add(action.pk)
+            key = (db, action.actor_ct_id, action.actor_pk, action.verb)
+            self.actions[key].append(action)
+            updated.add(key)
+
+        if len(keys) == 1:
+            # actions have been added to already retrieved ones
+            for key in updated:
+                self.actions[key].sort(key=attrgetter('timestamp'),
+                                       reverse=True)
+
+    def get(self, actor, verb, from_tstamp, to_tstamp, fingerprints=None):
+        """
+        Returns the candidate actions for actor and verb between from_tstamp
+        and to_tstamp, the most recent first. If the fingerprints of the
+        targets and related objects of the action to group are provided, only
+        the actions with the same targets or related objects are returned
+        """
+        if actor is None:
+            return []
+
+        key = self._key(actor, verb)
+        actions = self.actions.get(key, ())
+
+        key_fingerprints = self.fingerprints.get(key, None)
+        if fingerprints is not None and key_fingerprints is not None:
+            targets_fp, related_fp = fingerprints
+            if targets_fp not in key_fingerprints[0] \
+            or related_fp not in key_fingerprints[1]:
+                # the targets or related objects have been changed by grouping
+                # since the candidates were retrieved
+                key_fingerprints[0].add(targets_fp)
+                key_fingerprints[1].add(related_fp)
+                self._fetch(key[0], [(key, ({targets_fp}, {related_fp}))])
+                actions = self.actions.get(key, ())
+            actions = [a for a in actions
+                       if a.targets_hash in (None, targets_fp)
+                       or a.related_hash == related_fp]
+
+        return [a for a in actions
+                if from_tstamp <= a.timestamp <= to_tstamp]
+
+    def get_set(self, action, attr):
+        """
+        Returns the targets or related objects of a candidate action,
+        including the changes made by grouping
+        """
+        try:
+            return set(self.sets[action][attr])
+        except KeyError:
+            return set(getattr(action, attr).all())
+
+    def update(self, action, action_kws):
+        """
+        Records the changes made to a candidate action by grouping
+        """
+        from .models import GM2M_ATTRS
+        for k, v in action_kws.items():
+            if k in GM2M_ATTRS:
+                self.sets.setdefault(action, {})[k] = set(v)
+            else:
+                setattr(action, k, v)
+        action.set_fingerprints(*[self.get_set(action, attr)
+                                  for attr in GM2M_ATTRS])
+        self.changed[action._state.db][action] = action
+
+    def save(self):
+        """
+        Saves the changes made to the candidate actions by grouping
+        """
+
+        # avoids circular imports
+        from .models import Action, UnreadTracker, InboxEntry, GM2M_ATTRS
+        from .gfk import get_content_type
+
+        for db, actions in self.changed.items():
+            actions = list(actions)
+
+            to_add = defaultdict(lambda: [])
+            to_remove = defaultdict(Q)
+            # the objects involved in the actions before and after grouping,
+            # and the objects added by grouping
+            involved = []
+            added = []
+            for action in actions:
+                gm2ms = {attr: set(getattr(action, attr).all())
+                         for attr in GM2M_ATTRS}
+                involved.append((action, gm2ms))
+                new_elts = {attr: set() for attr in GM2M_ATTRS}
+                added.append((action, new_elts))
+                for attr, elts in self.sets.get(action, {}).items():
+                    initial = gm2ms[attr]
+                    gm2ms[attr] = initial.union(elts)
+                    new_elts[attr] = elts.difference(initial)
+                    through, objs = mk_through_objs(action, attr,
+                                                    new_elts[attr])
+                    to_add[through].extend(objs)
+                    for elt in initial.difference(elts):
+                        to_remove[through] |= Q(
+                            gm2m_src=action,
+                            gm2m_ct=get_content_type(elt),
+                            gm2m_pk=elt.pk
+                        )
+
+            with transaction.atomic(using=db):
+                Action.objects.db_manager(db) \
+                              .bulk_update(actions, ['data', 'level',
+                                                     'targets_hash',
+                                                     'related_hash'])
+                for through, q in to_remove.items():
+                    through._default_manager.using(db).filter(q).delete()
+                for through, objs in to_add.items():
+                    through._default_manager.using(db).bulk_create(objs)
+                added = [(a, elts) for a, elts in added
+                         if any(elts.values())]
+                UnreadTracker.fan_out(added, db, grouped=True)
+                InboxEntry.fan_out(added, db, grouped=True)
+
+            feed_cache.invalidate_actions(involved, db)
+
+
+class QueueStats(object):
+    """
+    Process-wide metrics about the saving of the actions queues
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            #: the number of times a non-empty queue has been saved
+            self.saves = 0
+            #: the number of saves triggered by QUEUE_MAX_SIZE or QUEUE_MAX_AGE
+            self.auto_saves = 0
+            #: the number of queued actions
+            self.queued = 0
+            #: the number of actions that have been created in the database
+            self.created = 0
+            #: the size of the largest saved queue
+            self.max_size = 0
+            #: the total time spent saving queues, in seconds
+            self.duration = 0.0
+
+    def add_save(self, size, created, duration):
+        with self.lock:
+            self.saves += 1
+            self.queued += size
+            self.created += created
+            self.max_size = max(self.max_size, size)
+            self.duration += duration
+
+    def add_auto_save(self):
+        with self.lock:
+            self.auto_saves += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {k: getattr(self, k)
+                    for k in ('saves', 'auto_saves', 'queued', 'created',
+                              'max_size', 'duration')}
+
+
+class ActionsSaver(object):
+    """
+    A bounded pool of worker threads that save the actions queues handed over
+    by ``ThreadActionsQueue.save`` in the background
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.slots = None
+        self.lock = Lock()
+
+    def submit(self, queue):
+        """
+        Drains the queue (and the deleted items registry) and schedules its
+        saving in a worker thread.
+
+        :return: ``False`` if the maximum number of pending queues is reached,
+                 in which case the queue is left untouched and should be saved
+                 synchronously
+        """
+
+        from .models import DeletedItem
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=SAVE_WORKERS)
+                self.slots = BoundedSemaphore(
+                    max(SAVE_WORKERS_BACKLOG, SAVE_WORKERS)
+                )
+            executor, slots = self.executor, self.slots
+
+        if not slots.acquire(blocking=False):
+            # the pool is saturated
+            return False
+
+        registry, del_items = queue.registry, DeletedItem.registry.items
+        queue.flush()
+
+        future = executor.submit(self._save, registry, del_items)
+        future.add_done_callback(lambda f: slots.release())
+        return True
+
+    @staticmethod
+    def _save(registry, del_items):
+        """
+        Saves a drained queue from a worker thread, using the worker thread's
+        own queue and deleted items registry
+        """
+
+        from .models import DeletedItem
+
+        close_old_connections()
+        try:
+            thread_actions_queue.reset()
+            thread_actions_queue.registry = registry
+            DeletedItem.registry.items = del_items
+            thread_actions_queue.save()
+        except Exception:
+            logger.exception('Could not save the actions queue')
+            thread_actions_queue.flush()
+        finally:
+            connections.close_all()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads, waiting for all the pending queues to be
+        saved if ``wait`` is ``True``. The workers are re-created on the next
+        call to ``submit``
+        """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
 thread_actions_queue = ThreadActionsQueue()
+queue_stats = QueueStats()
+actions_saver = ActionsSaver()
+
+# drain the pending queues before the interpreter exits
+atexit.register(actions_saver.shutdown)
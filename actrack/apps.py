@@ -1,5 +1,5 @@
 from django.apps import AppConfig
-from django.core.signals import request_finished
+from django.core.signals import request_started, request_finished
 
 from gm2m.signals import deleting
 
@@ -9,7 +9,9 @@ class ActrackConfig(AppConfig):
 
     def ready(self):
         from .signals import log_action, save_queue
-        from .actions import create_action, save_queue as do_save_queue
+        from .actions import create_action, save_queue as do_save_queue, \
+            save_queue_on_exit, reset_queue, start_unread_cache, \
+            clear_unread_cache
         from .deletion import handle_deleted_items
 
         log_action.connect(create_action, dispatch_uid='actrack_action')
@@ -17,5 +19,11 @@ class ActrackConfig(AppConfig):
                          dispatch_uid='actrack_mkdeleted')
 
         save_queue.connect(do_save_queue, dispatch_uid='actrack_save')
-        request_finished.connect(do_save_queue,
+        request_started.connect(reset_queue,
+                                dispatch_uid='actrack_reset_on_start')
+        request_finished.connect(save_queue_on_exit,
                                  dispatch_uid='actrack_save_on_exit')
+        request_started.connect(start_unread_cache,
+                                dispatch_uid='actrack_unread_cache_start')
+        request_finished.connect(clear_unread_cache,
+                                 dispatch_uid='actrack_unread_cache_clear')
@@ -0,0 +1,106 @@
+"""
+Versioned cache of the users' feed pages
+"""
+
+from functools import partial
+from hashlib import sha1
+from time import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .settings import FEED_CACHE, FEED_CACHE_TIMEOUT, READABLE_LEVEL
+
+
+class FeedCache(object):
+    """
+    Caches the pages of the users' feeds in the FEED_CACHE cache.
+
+    The keys of the pages include a version number per user. Invalidating a
+    user's feed deletes the version, so that a new one is generated the next
+    time the feed is retrieved and the outdated pages are never read again.
+    They expire after FEED_CACHE_TIMEOUT seconds.
+    """
+
+    prefix = 'actrack:feed'
+
+    @property
+    def enabled(self):
+        return FEED_CACHE is not None
+
+    @property
+    def cache(self):
+        return caches[FEED_CACHE]
+
+    def version_key(self, db, user_pk):
+        return '%s:%s:%s' % (self.prefix, db, user_pk)
+
+    def version(self, db, user_pk):
+        """
+        The current version of a user's feed
+        """
+        key = self.version_key(db, user_pk)
+        version = self.cache.get(key)
+        if version is None:
+            # a time-based version never matches the version of pages cached
+            # before the key was deleted. add does not overwrite a version
+            # that was generated concurrently
+            self.cache.add(key, int(time() * 1000000), None)
+            version = self.cache.get(key)
+        return version
+
+    def get_page(self, db, user_pk, params, get_page):
+        """
+        Returns a page of a user's feed from the cache, or calls get_page and
+        caches its result if it is not there
+
+        :param params: a tuple of the parameters used to retrieve the page
+        """
+        key = '%s:%s:%s' % (
+            self.version_key(db, user_pk), self.version(db, user_pk),
+            sha1(repr(params).encode('utf-8')).hexdigest()
+        )
+        return self.cache.get_or_set(key, get_page, FEED_CACHE_TIMEOUT)
+
+    def invalidate(self, db, user_pks):
+        """
+        Invalidates the cached pages of users' feeds once the current
+        transaction is committed, so that pages read before the changes are
+        visible are not cached under the new versions
+        """
+        if self.enabled and user_pks:
+            transaction.on_commit(
+                partial(self.cache.delete_many,
+                        [self.version_key(db, pk) for pk in user_pks]),
+                using=db
+            )
+
+    def invalidate_actions(self, actions, db):
+        """
+        Invalidates the feeds of the users who track the objects involved in
+        saved actions, and of the users who are the actors
+
+        :param actions: a list of (Action instance, gm2ms dict) tuples
+        """
+        if not self.enabled:
+            return
+
+        # avoids circular imports
+        from .models import Tracker, union_batches
+        from .gfk import get_content_type
+        from .managers.inst import get_user_model
+
+        user_ct = get_content_type(get_user_model())
+        user_pks = {a.actor_pk for a, __ in actions
+                    if a.actor_ct_id == user_ct.pk
+                    and a.level >= READABLE_LEVEL}
+
+        querysets = [qs.values_list('user_id')
+                     for __, qs in Tracker.following(actions, db)]
+        for qs in union_batches(querysets):
+            user_pks.update(pk for pk, in qs)
+
+        self.invalidate(db, user_pks)
+
+
+feed_cache = FeedCache()
@@ -11,7 +11,6 @@ class ReverseOneToOneDescriptor(OriginalReverseOneToOneDescriptor):
     """
     For OneToOneField, inspiration from django-annoying
     """
-    @atomic
     def __get__(self, instance, instance_type=None):
         try:
             model = self.related.related_model
@@ -22,18 +21,22 @@ class ReverseOneToOneDescriptor(OriginalReverseOneToOneDescriptor):
             return super(ReverseOneToOneDescriptor, self) \
                 .__get__(instance, instance_type)
         except model.DoesNotExist:
-            # actually a RelatedObjectDoesNotExist exception
-            # this creates the object if it does not exist
-            # we use get_or_create to better handle race conditions than save()
-            model.objects.using(instance._state.db) \
-                .get_or_create(**{self.related.field.name: instance})
-            try:
-                # django < 2.0
-                delattr(instance, self.cache_name)
-            except AttributeError:
-                pass
-            return super(ReverseOneToOneDescriptor, self) \
-                .__get__(instance, instance_type)
+            # the savepoint is only needed when the object is created
+            return self._create(model, instance, instance_type)
+
+    @atomic
+    def _create(self, model, instance, instance_type):
+        # this creates the object if it does not exist
+        # we use get_or_create to better handle race conditions than save()
+        model.objects.using(instance._state.db) \
+            .get_or_create(**{self.related.field.name: instance})
+        try:
+            # django < 2.0
+            delattr(instance, self.cache_name)
+        except AttributeError:
+            pass
+        return super(ReverseOneToOneDescriptor, self) \
+            .__get__(instance, instance_type)
 
 
 class ActrackDescriptor(object):
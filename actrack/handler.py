@@ -124,12 +124,12 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
             handler=self,
         )
 
-        try:
-            context.setdefault('unread',
-                               self.action.is_unread_for(context['user']))
-        except KeyError:
-            # no user in context
-            pass
+        if 'unread' not in context:
+            try:
+                context['unread'] = self.action.is_unread_for(context['user'])
+            except KeyError:
+                # no user in context
+                pass
 
         return context
 
@@ -176,13 +176,10 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
         combined and should not be saved
         """
 
-        i = len(cls.queue)
-        while i and cls.queue:
-            i -= 1
-            handler_class, kws = cls.queue[i]
+        for entry in cls.queue.combination_candidates(cls, kwargs):
+            handler_class, kws = entry
 
-            if kws.get('actor') != kwargs.get('actor') \
-            or not kwargs.get('targets').issubset(kws.get('targets')):
+            if not kwargs.get('targets').issubset(kws.get('targets')):
                 continue
 
             try:
@@ -200,7 +197,7 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
                 if handler_class._combinators[kwargs['verb']](
                 handler_class, kws, kwargs) is True:
                     handler_class._merge(kwargs, kws)
-                    del cls.queue[i]
+                    cls.queue.remove(entry)
             except KeyError:
                 pass
 
@@ -218,24 +215,58 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
             return True
 
     @classmethod
-    def _group(cls, kwargs):
+    def _grouping_window(cls, kwargs):
+        """
+        Returns the (from, to) timestamps between which saved actions may be
+        grouped with the action described by the kwargs, or None if database
+        grouping is disabled for this action
+        """
+        grouping = kwargs.get('grouping_delay', GROUPING_DELAY)
+        if grouping == -1 or not grouping:
+            return None
+        to_tstamp = kwargs['timestamp']
+        return to_tstamp - timedelta(seconds=grouping), to_tstamp
+
+    @classmethod
+    def _fingerprints(cls, actor, verb, kwargs):
+        """
+        Returns the fingerprints of the targets and related objects of an
+        action, that identify the saved actions it may be grouped with using
+        the default ``group`` implementation. Returns None if ``group`` is
+        customized
+        """
+        if getattr(cls.group, '__func__', None) \
+        is not ActionHandler.group.__func__:
+            return None
+
+        from .models import mk_fingerprint
+        from .gfk import get_content_type
+
+        actor_ct_id = get_content_type(actor).pk
+        actor_pk = str(actor.pk)
+        return tuple(mk_fingerprint(actor_ct_id, actor_pk, verb,
+                                    kwargs.get(attr, None) or ())
+                     for attr in ('targets', 'related'))
+
+    @classmethod
+    def _group(cls, kwargs, bucket=None, db_candidates=None):
         """
         Determines if an action described by the kwargs should be merged with
         one of its predecessors or not. Can be overridden to customize the
         grouping behavior
+        :param bucket: the queued actions (as a ``GroupingBucket`` of kwargs)
+        with the same verb, actor and database that precede the action. If not
+        provided, all the other actions in ``cls.queue`` are considered
+        :param db_candidates: the saved actions that may be grouped with the
+        action (as ``DBGroupingCandidates``). If not provided, they are
+        retrieved from the database and the grouped action is saved straight
+        away
         :return: ``True`` if the action described by the kwargs has been grouped
         and should not be added to the queue
         """
 
         from .gfk import get_content_type
 
-        kwargs['__current__'] = True
-        queue = []
-        for a in cls.queue:
-            if not a[1].get('__current__', False):
-                queue.append(a)
-        kwargs.pop('__current__')
-
         grouping = kwargs.pop('grouping_delay', GROUPING_DELAY)
 
         if grouping == -1:
@@ -247,6 +278,9 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
         # to avoid circular imports
         from .models import Action, GM2M_ATTRS
 
+        if bucket is None:
+            queue = [kwg for __, kwg in cls.queue if kwg is not kwargs]
+
         kwargs = copy(kwargs)
 
         to_tstamp = kwargs.pop('timestamp')
@@ -256,9 +290,19 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
         verb = kwargs.pop('verb')
         using = kwargs.pop('using', None)
 
+        fingerprints = actor and cls._fingerprints(actor, verb, kwargs)
+
+        if bucket is not None:
+            # with the default grouping implementation, the queued actions
+            # the action may be grouped with are looked up by fingerprint
+            queue = bucket.matching(fingerprints)
+            if queue is None:
+                queue = bucket.window(from_tstamp, to_tstamp) if grouping \
+                    else bucket
+
         # try and retrieve recent existing action, as well as difference in
         # targets and related objects
-        for hdlr_cls, kwg in queue:
+        for kwg in queue:
             tstamp = kwg['timestamp']
             if kwg['verb'] != verb or kwg['actor'] != actor \
             or using != kwg.get('using', None) \
@@ -268,25 +312,37 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
             if cls.group(kwargs, kwg):
                 # do group
                 cls._merge(kwg, kwargs)
+                if bucket is not None and fingerprints is not None:
+                    bucket.reindex(kwg, cls._fingerprints(actor, verb, kwg))
                 return True
 
         if not grouping:
             # database grouping is disabled
             return
 
-        for action in Action.objects.db_manager(actor._state.db) \
+        if db_candidates is None:
+            actions = Action.objects.db_manager(actor._state.db) \
                 .prefetch_related(*GM2M_ATTRS) \
                 .filter(timestamp__gte=from_tstamp,
                         timestamp__lte=to_tstamp,
                         actor_ct=actor and get_content_type(actor),
                         actor_pk=actor and actor.pk,
-                        verb=verb):
+                        verb=verb)
+        else:
+            actions = db_candidates.get(actor, verb, from_tstamp, to_tstamp,
+                                        fingerprints)
+
+        for action in actions:
 
             action_kws = {}
             for field in ['data', 'level', 'related', 'targets']:
-                value = getattr(action, field)
                 if field in GM2M_ATTRS:
-                    value = set(value.all())
+                    if db_candidates is None:
+                        value = set(getattr(action, field).all())
+                    else:
+                        value = db_candidates.get_set(action, field)
+                else:
+                    value = getattr(action, field)
                 if field == 'data':
                     action_kws.update(value)
                 else:
@@ -294,9 +350,16 @@ class ActionHandler(metaclass=ActionHandlerMetaclass):
 
             if cls.group(kwargs, action_kws):
                 cls._merge(action_kws, kwargs)
-                for k, v in action_kws.items():
-                    setattr(action, k, v)
-                action.save()
+                if db_candidates is None:
+                    for k, v in action_kws.items():
+                        setattr(action, k, v)
+                    action.set_fingerprints(action_kws['targets'],
+                                            action_kws['related'])
+                    action.save()
+                else:
+                    # the action will be saved along with the other grouped
+                    # actions
+                    db_candidates.update(action, action_kws)
                 return True
 
         # no matching action could be found, a new action must be created,
@@ -2,7 +2,10 @@
 Misc helper function
 """
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
 from django.utils.translation import ugettext as _
+from django.utils.dateparse import parse_datetime
 
 
 def to_set(obj):
@@ -36,3 +39,31 @@ def str_enum(it):
         # the list of objects contains more than 3 items, print only the 1st
         # 2 ones and give a number
         return _('%s and %d others') % (', '.join(it[0:2]), l - 2)
+
+
+def encode_cursor(timestamp, pk):
+    """
+    Encodes a (timestamp, pk) position into an opaque cursor string
+    """
+
+    value = '%s|%s' % (timestamp.isoformat(), pk)
+    return urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor generated by encode_cursor into a (timestamp, pk) tuple
+    Raises ValueError if the cursor is invalid
+    """
+
+    try:
+        value = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, pk = value.split('|')
+        timestamp = parse_datetime(timestamp)
+        pk = int(pk)
+    except (AttributeError, TypeError, ValueError):
+        timestamp = None
+
+    if timestamp is None:
+        raise ValueError('Invalid cursor: %r' % cursor)
+    return timestamp, pk
@@ -0,0 +1,47 @@
+"""
+Request-local storage, that works with asyncio as well as with threads
+"""
+
+try:
+    # asgiref is a dependency of django >= 3.0
+    from asgiref.local import Local
+    from asgiref.sync import sync_to_async
+except ImportError:
+    from threading import local as Local
+    sync_to_async = None
+
+
+class RequestLocal(object):
+    """
+    A base class for objects which attributes are local to the current thread
+    (WSGI) or to the current asyncio task (ASGI), in the same way as django's
+    database connections.
+
+    The attributes are initialized by the ``initialize`` method, which
+    subclasses must implement, the first time they are accessed in a thread or
+    a task, or when ``reset`` is called.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, '_storage', Local())
+
+    def __getattr__(self, name):
+        # only called for attributes that are not defined in the class
+        storage = self._storage
+        try:
+            return getattr(storage, name)
+        except AttributeError:
+            if getattr(storage, '_initialized', False):
+                raise
+        self.reset()
+        return getattr(storage, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._storage, name, value)
+
+    def reset(self):
+        self._storage._initialized = True
+        self.initialize()
+
+    def initialize(self):
+        raise NotImplementedError
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import InboxEntry
+from ...settings import INBOX
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the users\' inboxes from their trackers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='The database to rebuild. Defaults to the "default" database.'
+        )
+
+    def handle(self, *args, **options):
+        if not INBOX:
+            raise CommandError('The INBOX setting is not enabled.')
+        count = InboxEntry.rebuild(using=options['database'])
+        self.stdout.write('%d inbox entries created' % count)
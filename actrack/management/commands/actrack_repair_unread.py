@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import UnreadTracker
+
+
+class Command(BaseCommand):
+    help = 'Reconciles the unread actions counts with the unread actions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='The database to repair. Defaults to the "default" database.'
+        )
+
+    def handle(self, *args, **options):
+        repaired = UnreadTracker.repair_counts(using=options['database'])
+        self.stdout.write('%d unread count(s) repaired' % repaired)
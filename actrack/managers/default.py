@@ -2,32 +2,162 @@
 Default managers (.objects) for Action and Tracker classes
 """
 
-from django.db.models import Manager, Q
+from django.db.models import Manager, QuerySet, Q, Value, TextField, \
+    OuterRef, Exists
+from django.db.models.functions import Concat, StrIndex
 
+from ..helpers import encode_cursor, decode_cursor
 
-class DefaultActionManager(Manager):
+
+def follows_verb(trackers, verb):
+    """
+    Filters a trackers queryset on the trackers following a verb. The verbs
+    are stored as a ';'-separated string, in which the verb token is looked
+    up with StrIndex rather than a LIKE, which ignores case on some databases
+
+    :param verb: an expression of the verb token, ';verb;'
+    """
+    return trackers.annotate(
+        verb_index=StrIndex(Concat(Value(';'), 'verbs', Value(';'),
+                                   output_field=TextField()), verb)
+    ).filter(Q(verbs__isnull=True) | Q(verb_index__gt=0))
+
+
+class ActionQuerySet(QuerySet):
+
+    def page(self, cursor=None, size=20):
+        """
+        A page of actions, from the most recent to the oldest. The actions are
+        ordered by (timestamp, id) and each page starts after the position
+        of the previous page's last action, so that no row is skipped or
+        retrieved twice when actions are inserted between two pages
+
+        :param cursor: the cursor returned with the previous page, or None to
+                       retrieve the first page
+        :param size: the maximum number of actions in the page
+        :returns: a (list of actions, next cursor) tuple. The next cursor is
+                  None if this is the last page
+        """
+
+        qs = self.order_by('-timestamp', '-pk')
+        if cursor is not None:
+            timestamp, pk = decode_cursor(cursor)
+            qs = qs.filter(Q(timestamp__lt=timestamp) |
+                           Q(timestamp=timestamp, pk__lt=pk))
+
+        actions = list(qs[:size + 1])
+        if len(actions) <= size:
+            return actions, None
+        actions = actions[:size]
+        return actions, encode_cursor(actions[-1].timestamp, actions[-1].pk)
+
+
+class DefaultActionManager(Manager.from_queryset(ActionQuerySet)):
+
+    def object_q(self, ct, pk, actor_only=False):
+        """
+        The query matching the actions involving an object, or any instance
+        of its model if pk is None. The targets and related objects are looked
+        up in subqueries rather than joins, so that no action is returned
+        twice and no DISTINCT clause is needed
+        """
+
+        from ..models import GM2M_ATTRS
+
+        actor = {'actor_ct': ct}
+        through_kws = {'gm2m_ct': ct}
+        if pk is not None:
+            actor['actor_pk'] = through_kws['gm2m_pk'] = pk
+
+        q = Q(**actor)
+        if not actor_only:
+            for attr in GM2M_ATTRS:
+                through = getattr(self.model, attr).through
+                q = q | Q(pk__in=through.objects.filter(**through_kws)
+                                                .values('gm2m_src'))
+        return q
+
+    def tracker_q(self, tracker):
+        """
+        The query matching the actions that are followed by a tracker
+        """
+
+        q = self.object_q(tracker.tracked_ct_id, tracker.tracked_pk,
+                          tracker.actor_only)
+        if tracker.verbs:
+            q = q & Q(verb__in=tracker.verbs)
+        return q
+
+    def last_timestamp(self):
+        """
+        The timestamp of the most recent action, a cheap indication of new
+        activity
+        """
+        return self.order_by('-timestamp') \
+                   .values_list('timestamp', flat=True).first()
 
     def tracked_by(self, tracker, **kwargs):
         """
         All the actions that are followed by a tracker
         """
 
-        ct = tracker.tracked_ct_id
-        pk = tracker.tracked_pk
-
         try:
             db = tracker._state.db
         except AttributeError:
             db = None
 
-        q = Q(actor_ct=ct, actor_pk=pk)
-        if not tracker.actor_only:
-            kws_targets = dict(action_targets__gm2m_ct=ct,
-                               action_targets__gm2m_pk=pk)
-            kws_related = dict(action_related__gm2m_ct=ct,
-                               action_related__gm2m_pk=pk)
-            q = q | Q(**kws_targets) | Q(**kws_related)
-        if tracker.verbs:
-            q = q & Q(verb__in=tracker.verbs)
+        return self.db_manager(db).filter(self.tracker_q(tracker), **kwargs)
+
+    def tracked_by_any(self, trackers, include=None, since_updated=False,
+                       **kwargs):
+        """
+        All the actions that are followed by any of the trackers in a
+        queryset. The trackers are matched in EXISTS subqueries, so that the
+        size of the SQL query does not depend on the number of trackers
+
+        :param include: a Q object matching other actions to retrieve
+        :param since_updated: if ``True``, each tracker only follows the
+                              actions that occurred since it was last updated
+        """
+
+        from ..models import GM2M_ATTRS
+
+        def matching(ct, pk, verb, timestamp):
+            # the trackers following an object and a verb
+            qs = follows_verb(trackers.order_by(), verb).filter(
+                Q(tracked_pk=pk) | Q(tracked_pk__isnull=True),
+                tracked_ct=ct,
+            )
+            if since_updated:
+                qs = qs.filter(last_updated__lte=timestamp)
+            return qs
+
+        annotations = {
+            'tracked_as_actor': Exists(matching(
+                OuterRef('actor_ct'), OuterRef('actor_pk'),
+                OuterRef('verb_token'), OuterRef('timestamp')
+            ))
+        }
+        for attr in GM2M_ATTRS:
+            through = getattr(self.model, attr).through
+            # the verb token is annotated on the through rows, as nested
+            # OuterRef cannot be used in expressions
+            annotations['tracked_as_%s' % attr] = Exists(
+                through.objects.filter(gm2m_src=OuterRef('pk')).annotate(
+                    verb_token=OuterRef('verb_token')
+                ).annotate(
+                    tracked=Exists(matching(
+                        OuterRef('gm2m_ct'), OuterRef('gm2m_pk'),
+                        OuterRef('verb_token'),
+                        OuterRef(OuterRef('timestamp'))
+                    ).filter(actor_only=False))
+                ).filter(tracked=True)
+            )
+
+        q = include or Q()
+        for name in annotations:
+            q = q | Q(**{name: True})
+        return self.annotate(verb_token=Concat(Value(';'), 'verb', Value(';'),
+                                               output_field=TextField())) \
+                   .annotate(**annotations).filter(q, **kwargs)
 
-        return self.db_manager(db).filter(q, **kwargs).distinct()
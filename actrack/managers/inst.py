@@ -6,16 +6,17 @@ They are set as accessors when connecting a Model to the action tracker and
 can be accessed via 'actions' or 'trackers' attributes on object instances
 """
 
-from collections import defaultdict
-
 from django.db.models import Q, Manager
 from django.db import router
 from django.core.exceptions import ImproperlyConfigured
 from django.apps import apps
 
-from ..models import Action, Tracker, GM2M_ATTRS
-from ..settings import TRACKERS_ATTR, USER_MODEL, READABLE_LEVEL
+from ..models import Action, Tracker, InboxEntry
+from ..settings import TRACKERS_ATTR, USER_MODEL, READABLE_LEVEL, INBOX
 from ..gfk import get_content_type
+from ..helpers import encode_cursor, decode_cursor
+from ..cache import feed_cache
+from .default import ActionQuerySet
 
 
 def get_user_model():
@@ -63,7 +64,7 @@ class InstActrackManager(Manager):
         """
         To call when one wants a shortcut to the unfiltered queryset
         """
-        return super(InstActrackManager, self).get_queryset().distinct()
+        return super(InstActrackManager, self).get_queryset()
 
 
 class InstActionManager(InstActrackManager):
@@ -71,6 +72,8 @@ class InstActionManager(InstActrackManager):
     This manager retrieves Action instances that are linked to the instance
     """
 
+    _queryset_class = ActionQuerySet
+
     def __init__(self, instance):
         super(InstActionManager, self).__init__(instance, Action)
 
@@ -80,16 +83,8 @@ class InstActionManager(InstActrackManager):
         or related objects
         """
 
-        ct = get_content_type(self.instance)
-        pk = self.instance.pk
-
-        # actor
-        q = Q(actor_ct=ct, actor_pk=self.instance.pk)
-
-        # targets and related
-        for a in GM2M_ATTRS:
-            q = q | Q(**mk_kws('action_%s__gm2m' % a, ct, pk))
-
+        q = Action.objects.object_q(get_content_type(self.instance),
+                                    self.instance.pk)
         return super(InstActionManager, self).get_queryset().filter(q)
 
     def as_actor(self, **kwargs):
@@ -139,64 +134,97 @@ class InstActionManager(InstActrackManager):
         # all the trackers owned by the user
         trackers = getattr(self.instance, TRACKERS_ATTR).owned()
 
-        actors_by_ct = defaultdict(lambda: defaultdict(lambda: []))
-        others_by_ct = defaultdict(lambda: defaultdict(lambda: []))
-
-        if include_own:
-            # if all the user's actions should be retrieved as well, pre-fill
-            # actors_by_ct
-            ct = get_content_type(self.instance).pk
-            actors_by_ct[ct][self.instance.pk] = None
-        elif not len(trackers):
+        if not include_own and not len(trackers):
             return self.none()
 
-        for t in trackers:
-            abct = actors_by_ct[t.tracked_ct_id]
-            pk = t.tracked_pk
-            if abct[pk] is None:
-                # the pk is already marked to 'use' all verbs
-                continue
-            obct = others_by_ct[t.tracked_ct_id]
-            if t.verbs:
-                # append the verbs if any
-                abct[pk].extend(t.verbs)
-                if not t.actor_only:
-                    obct[pk].extend(t.verbs)
-            else:
-                # else mark the tracked object as 'tracking all verbs'
-                abct[pk] = None
-                if not t.actor_only:
-                    obct[pk] = None
-
-            # mark any new message matching the tracker as unread if required
-            # we do it here because it's more efficient to collect a bunch
-            # of unread actions matching the tracker now than searching and
-            # updating every tracker on action creation
-            t.update_unread()
-
-        # now we've got a dictionary actors_by_ct containing all the verbs to
-        # be tracked, listed by content type and pks of tracked objects
-        # from that we build a query to filter Action objects
-
-        q = Q()
-
-        # first we take care of actors
-        for ct, pk_verbs in actors_by_ct.items():
-            for pk, verbs in pk_verbs.items():
-                q = q | Q(**mk_kws('actor', ct, pk, verbs=verbs))
-
-        # now we take care of targets and related objects
-        for ct, pk_verbs in others_by_ct.items():
-            for pk, verbs in pk_verbs.items():
-                subq = Q(**mk_kws('action_targets__gm2m', ct, pk)) | \
-                       Q(**mk_kws('action_related__gm2m', ct, pk))
-                if verbs:
-                    subq = subq & Q(verb__in=verbs)
-                q = q | subq
+        # mark any new message matching the trackers as unread if required
+        # we do it here because it's more efficient to collect a bunch
+        # of unread actions matching the trackers now than searching and
+        # updating every tracker on action creation
+        Tracker.bulk_update_unread(self.instance, trackers)
 
         level__gte = kwargs.pop('level__gte', 0)
         kwargs['level__gte'] = max(level__gte, READABLE_LEVEL)
-        return super(InstActionManager, self).get_queryset().filter(q, **kwargs)
+
+        include = None
+        if include_own:
+            include = Q(actor_ct=get_content_type(self.instance),
+                        actor_pk=self.instance.pk)
+
+        if INBOX:
+            # the tracked actions are already listed in the user's inbox,
+            # apart from the ones involving crowded objects
+            crowded = Tracker.crowded(trackers)
+            if not include_own and not crowded.exists():
+                return Action.objects.db_manager(self._db) \
+                    .filter(inbox_entries__user=self.instance, **kwargs) \
+                    .order_by('-inbox_entries__timestamp')
+            inbox = Q(pk__in=InboxEntry.objects.db_manager(self._db)
+                                       .filter(user=self.instance)
+                                       .values('action'))
+            include = inbox | include if include else inbox
+            trackers = crowded
+
+        return Action.objects.db_manager(self._db) \
+                     .tracked_by_any(trackers, include, **kwargs)
+
+    def feed_page(self, cursor=None, size=20, **kwargs):
+        """
+        A page of the actions tracked by the user, as returned by the page
+        method of the feed queryset. The pages are cached if the FEED_CACHE
+        setting is set
+        Only applicable if instance is a user object (TypeError thrown if not)
+        """
+
+        def get_page():
+            return self.feed(**kwargs).page(cursor, size)
+
+        if not self.is_user:
+            raise TypeError(
+                'Cannot call "feed_page" on an object which is not a user.')
+
+        if not feed_cache.enabled:
+            return get_page()
+        return feed_cache.get_page(self._db, self.instance.pk,
+                                   (cursor, size, sorted(kwargs.items())),
+                                   get_page)
+
+    def feed_since(self, cursor=None, **kwargs):
+        """
+        The actions tracked by the user that are more recent than the
+        position encoded in a cursor, from the most recent to the oldest.
+        The actions are compared by timestamp, so an action saved after the
+        cursor has moved past its timestamp (e.g. a queued action saved late)
+        is not returned.
+        Only applicable if instance is a user object (TypeError thrown if not)
+
+        :param cursor: a cursor returned by a previous call to feed_since or
+                       by the page method of a feed queryset. If None, no
+                       action is returned and only the cursor is generated
+        :returns: a (list of actions, cursor) tuple. The cursor is to be
+                  provided in the next call to retrieve the newer actions
+        """
+
+        if cursor is None:
+            last = self.feed(**kwargs).order_by('-timestamp', '-pk') \
+                       .only('timestamp').first()
+            if last is None:
+                return [], None
+            return [], encode_cursor(last.timestamp, last.pk)
+
+        timestamp, pk = decode_cursor(cursor)
+        newer = Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+
+        # no need to retrieve the feed if no action has been saved after the
+        # cursor's position
+        if not Action.objects.db_manager(self._db).filter(newer).exists():
+            return [], cursor
+
+        actions = list(self.feed(**kwargs).filter(newer)
+                                          .order_by('-timestamp', '-pk'))
+        if not actions:
+            return [], cursor
+        return actions, encode_cursor(actions[0].timestamp, actions[0].pk)
 
 
 class InstTrackerManager(InstActrackManager):
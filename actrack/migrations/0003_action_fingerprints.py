@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actrack', '0002_alter_action_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='targets_hash',
+            field=models.CharField(max_length=40, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='action',
+            name='related_hash',
+            field=models.CharField(max_length=40, null=True, db_index=True),
+        ),
+    ]
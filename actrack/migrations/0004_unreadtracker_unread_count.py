@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def init_unread_count(apps, schema_editor):
+    UnreadTracker = apps.get_model('actrack', 'UnreadTracker')
+    db = schema_editor.connection.alias
+    trackers = list(UnreadTracker.objects.using(db).annotate(
+        actual=models.Count('unread_actions')
+    ).filter(actual__gt=0))
+    for t in trackers:
+        t.unread_count = t.actual
+    UnreadTracker.objects.using(db).bulk_update(trackers, ['unread_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actrack', '0003_action_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unreadtracker',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(init_unread_count, migrations.RunPython.noop),
+    ]
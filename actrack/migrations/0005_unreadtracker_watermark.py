@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actrack', '0004_unreadtracker_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unreadtracker',
+            name='read_until',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='unreadtracker',
+            name='read_actions',
+            field=models.ManyToManyField(related_name='read_in', to='actrack.Action'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actrack', '0005_unreadtracker_watermark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='action',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, db_index=True),
+        ),
+    ]
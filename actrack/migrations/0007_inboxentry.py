@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from actrack import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.USER_MODEL),
+        ('actrack', '0006_action_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('action', models.ForeignKey(related_name='inbox_entries', to='actrack.Action', on_delete=models.CASCADE)),
+                ('user', models.ForeignKey(related_name='+', to=settings.USER_MODEL, on_delete=models.CASCADE)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', '-timestamp'], name='actrack_inb_user_id_892e34_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='inboxentry',
+            unique_together={('user', 'action')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actrack', '0007_inboxentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tracker',
+            index=models.Index(fields=['tracked_ct', 'tracked_pk'], name='actrack_tra_tracked_44cc4b_idx'),
+        ),
+    ]
@@ -1,6 +1,10 @@
-from threading import local
+from collections import defaultdict
+from datetime import timedelta
+from hashlib import sha1
 
-from django.db import models
+from django.db import models, transaction, connections
+from django.db.models import F, Q, Count, Max, Value, OuterRef, Subquery
+from django.db.models.functions import Greatest
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.utils.timezone import now
@@ -9,16 +13,87 @@ from gm2m import GM2MField
 from jsonfield import JSONField
 
 from .handler import ActionHandlerMetaclass
-from .managers.default import DefaultActionManager
+from .managers.default import DefaultActionManager, follows_verb
 from .settings import USER_MODEL, TRACK_UNREAD, AUTO_READ, PK_MAXLENGTH, \
-    DEFAULT_LEVEL, READABLE_LEVEL
+    DEFAULT_LEVEL, READABLE_LEVEL, UNREAD_WATERMARK, UNREAD_REFRESH_INTERVAL, \
+    UNREAD_FANOUT, INBOX, INBOX_MAX_TRACKERS, ACTIONS_ATTR
 from .fields import OneToOneField, VerbsField
+from .local import RequestLocal
 from .gfk import ModelGFK, get_content_type
 
 
 GM2M_ATTRS = ('targets', 'related')
 
 
+def mk_fingerprint(actor_ct_id, actor_pk, verb, objs):
+    """
+    Returns a fingerprint of an actor, a verb and a set of objects, that is
+    used to find the actions an action may be grouped with
+    """
+    elts = []
+    for obj in objs:
+        if obj.pk is None:
+            # a deleted item
+            try:
+                obj = DeletedItem.registry[obj]
+            except KeyError:
+                continue
+        elts.append('%d:%s' % (get_content_type(obj).pk, obj.pk))
+    elts.sort()
+    return sha1(';'.join(
+        ['%s:%s' % (actor_ct_id, actor_pk), verb] + elts
+    ).encode('utf-8')).hexdigest()
+
+
+#: the number of querysets combined with UNION in one query, as databases
+#: limit the number of SELECT in a compound query
+UNION_BATCH_SIZE = 100
+
+
+def union(querysets):
+    """
+    Combines querysets with UNION, without duplicate rows
+    """
+    if len(querysets) == 1:
+        return querysets[0].distinct()
+    return querysets[0].union(*querysets[1:])
+
+
+def union_batches(querysets):
+    """
+    Yields the querysets combined with UNION, by batches of UNION_BATCH_SIZE
+    """
+    for i in range(0, len(querysets), UNION_BATCH_SIZE):
+        yield union(querysets[i:i + UNION_BATCH_SIZE])
+
+
+def insert_select(model, fields, queryset, using):
+    """
+    Inserts the rows selected by queryset into model's table, in one
+    INSERT ... SELECT query
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    sql, params = queryset.query.get_compiler(using).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) %s' % (
+            qn(model._meta.db_table),
+            ', '.join(qn(model._meta.get_field(f).column) for f in fields),
+            sql
+        ), params)
+
+
+def insert_select_batches(model, fields, querysets, using):
+    """
+    Inserts the rows selected by querysets into model's table, with one
+    INSERT ... SELECT query per batch of querysets (see union_batches), so
+    that the number of queries does not depend on the number of rows, e.g.
+    when the actions are fanned out to the users tracking them
+    """
+    for qs in union_batches(querysets):
+        insert_select(model, fields, qs, using)
+
+
 class Action(models.Model):
     """
     An action initiated by an actor and described by a verb.
@@ -52,7 +127,12 @@ class Action(models.Model):
     data = JSONField(default={})
 
     #: The timestamp of the action, from which actions are ordered
-    timestamp = models.DateTimeField(default=now)
+    timestamp = models.DateTimeField(default=now, db_index=True)
+
+    # fingerprints of the actor, verb and targets or related objects, to find
+    # the actions an action may be grouped with
+    targets_hash = models.CharField(max_length=40, null=True, db_index=True)
+    related_hash = models.CharField(max_length=40, null=True, db_index=True)
 
     # default manager
     objects = DefaultActionManager()
@@ -65,6 +145,16 @@ class Action(models.Model):
         self._unread_in_cache = {}
         self.handler = ActionHandlerMetaclass.create_handler(self)
 
+    def set_fingerprints(self, targets, related):
+        """
+        Sets the fingerprints used for grouping from the targets and related
+        objects of the action
+        """
+        self.targets_hash = mk_fingerprint(self.actor_ct_id, self.actor_pk,
+                                           self.verb, targets)
+        self.related_hash = mk_fingerprint(self.actor_ct_id, self.actor_pk,
+                                           self.verb, related)
+
     def _render(self, context=None):
         """
         Renders the action from a template
@@ -75,9 +165,7 @@ class Action(models.Model):
         """
         Returns True if the action is unread for that user
         """
-        if self in user.unread_actions.all():
-            return True
-        return False
+        return user.unread_actions.is_unread(self)
 
     def mark_read_for(self, user, force=False):
         """
@@ -106,14 +194,13 @@ class Action(models.Model):
     @classmethod
     def bulk_is_unread_for(cls, user, actions):
         """
-        Does not bring any performance gains over Action.is_read method, exists
-        for the sake of consistency with bulk_mark_read_for and bulk_render
+        Returns a list of booleans telling if the actions which level is at
+        least READABLE_LEVEL are unread for the given user. Only one query is
+        needed for all the actions
         """
-        unread = []
-        for a in actions:
-            if a.level >= READABLE_LEVEL:
-                unread.append(a.is_unread_for(user))
-        return unread
+        actions = [a for a in actions if a.level >= READABLE_LEVEL]
+        unread_pks = user.unread_actions.unread_pks(actions)
+        return [a.pk in unread_pks for a in actions]
 
     @classmethod
     def bulk_mark_read_for(cls, user, actions, force=False):
@@ -126,17 +213,18 @@ class Action(models.Model):
         the call to bulk_mark_read_for, ``l[i]`` is True
         """
 
-        unread_actions = user.unread_actions.all()
+        unread_tracker = user.unread_actions
+        unread_pks = unread_tracker.unread_pks(actions)
 
         unread = []
         to_mark_read = []
         for a in actions:
-            is_unread = a in unread_actions
+            is_unread = a.pk in unread_pks
             unread.append(is_unread)
             if is_unread:
                 to_mark_read.append(a)
 
-        user.unread_actions.bulk_mark_read(to_mark_read, force)
+        unread_tracker.bulk_mark_read(to_mark_read, force)
 
         return unread
 
@@ -170,9 +258,49 @@ class Action(models.Model):
         return rendered
 
 
+class UnreadCache(RequestLocal):
+    """
+    Caches the unread state of the actions for each user during a request, so
+    that the rendering paths do not query the database several times for the
+    same action. The cache is only enabled during requests
+    """
+
+    def initialize(self):
+        self.states = None
+
+    def start(self):
+        self.states = {}
+
+    def get(self, unread_tracker):
+        """
+        Returns the {action pk: unread} dictionary for the user of an
+        UnreadTracker, or None if the cache is disabled
+        """
+        if self.states is None:
+            return None
+        key = (unread_tracker._state.db, unread_tracker.user_id)
+        return self.states.setdefault(key, {})
+
+    def set(self, unread_tracker, actions, unread):
+        states = self.get(unread_tracker)
+        if states is not None:
+            for a in actions:
+                states[getattr(a, 'pk', a)] = unread
+
+    def reset_user(self, unread_tracker):
+        if self.states is not None:
+            self.states.pop((unread_tracker._state.db,
+                             unread_tracker.user_id), None)
+
+
 class UnreadTracker(models.Model):
     """
     A model to keep track of unread actions for each user
+
+    By default, each unread action is stored in ``unread_actions``. If the
+    UNREAD_WATERMARK setting is True, the readable actions more recent than
+    ``read_until`` are unread unless they are in ``read_actions``, and the
+    older ones are read unless they are in ``unread_actions``
     """
 
     user = OneToOneField(USER_MODEL, on_delete=models.CASCADE,
@@ -180,25 +308,324 @@ class UnreadTracker(models.Model):
 
     unread_actions = models.ManyToManyField(Action, related_name='unread_in')
 
+    #: The number of unread actions, updated when actions are marked as read
+    #: or unread
+    unread_count = models.PositiveIntegerField(default=0)
+
+    # watermark mode only
+    read_until = models.DateTimeField(null=True)
+    read_actions = models.ManyToManyField(Action, related_name='read_in')
+
+    cache = UnreadCache()
+
     def all(self):
-        return self.unread_actions.all()
+        if not UNREAD_WATERMARK:
+            return self.unread_actions.all()
+        return getattr(self.user, ACTIONS_ATTR).feed().filter(
+            Q(timestamp__gt=self.watermark) & ~Q(read_in=self) |
+            Q(unread_in=self)
+        )
+
+    def count(self):
+        """
+        Returns the number of unread actions, from the database as it may have
+        been updated through another instance
+        """
+        self.unread_count = UnreadTracker.objects \
+            .db_manager(self._state.db).filter(pk=self.pk) \
+            .values_list('unread_count', flat=True)[0]
+        return self.unread_count
+
+    @property
+    def watermark(self):
+        """
+        The timestamp until which the actions are read in watermark mode. It
+        is initialized the first time it is needed, so that the actions marked
+        as unread beforehand remain unread
+        """
+        if self.read_until is None:
+            self.read_until = now()
+            UnreadTracker.objects.db_manager(self._state.db) \
+                                 .filter(pk=self.pk, read_until=None) \
+                                 .update(read_until=self.read_until)
+        return self.read_until
+
+    def _split(self, actions):
+        """
+        Splits actions in two lists, the readable actions that are more recent
+        than the watermark and the others
+        """
+        watermark = self.watermark
+        recent, old = [], []
+        for a in actions:
+            if a.timestamp > watermark and a.level >= READABLE_LEVEL:
+                recent.append(a)
+            else:
+                old.append(a)
+        return recent, old
+
+    def _pks_in(self, m2m, pks):
+        """
+        Returns the subset of pks that are in the m2m relation, in one query
+        """
+        if not pks:
+            return set()
+        through = getattr(self, m2m).through
+        return set(through.objects.db_manager(self._state.db)
+                                  .filter(unreadtracker_id=self.pk,
+                                          action_id__in=pks)
+                                  .values_list('action_id', flat=True))
+
+    def is_unread(self, action):
+        """
+        Returns True if the action is unread, without retrieving all the unread
+        actions
+        """
+        states = self.cache.get(self)
+        try:
+            return states[action.pk]
+        except (TypeError, KeyError):
+            pass
+
+        if UNREAD_WATERMARK and self._split((action,))[0]:
+            m2m, unread_if_in = 'read_actions', False
+        else:
+            m2m, unread_if_in = 'unread_actions', True
+
+        through = getattr(self, m2m).through
+        unread = through.objects.db_manager(self._state.db) \
+                                .filter(unreadtracker_id=self.pk,
+                                        action_id=action.pk) \
+                                .exists() is unread_if_in
+        if states is not None:
+            states[action.pk] = unread
+        return unread
+
+    def unread_pks(self, actions):
+        """
+        Returns the set of the primary keys of the unread actions among
+        actions, retrieved in one query (two in watermark mode)
+        """
+        states = self.cache.get(self)
+        if states is None:
+            states = {}
+            unknown = actions
+        else:
+            unknown = [a for a in actions if a.pk not in states]
+
+        if unknown:
+            if UNREAD_WATERMARK:
+                recent, old = self._split(unknown)
+                recent = [a.pk for a in recent]
+                read = self._pks_in('read_actions', recent)
+                for pk in recent:
+                    states[pk] = pk not in read
+            else:
+                old = unknown
+            old = [a.pk for a in old]
+            unread = self._pks_in('unread_actions', old)
+            for pk in old:
+                states[pk] = pk in unread
+
+        return {a.pk for a in actions if states[a.pk]}
 
     def mark_unread(self, *actions):
-        self.unread_actions.add(*actions)
+        return self._mark_unread(actions)
+
+    def _mark_unread(self, actions, fetched=False):
+        """
+        :param fetched: ``True`` if the actions have just been fetched from the
+                        user's feed, in which case none of them has been
+                        counted as unread yet
+        """
+        db = self._state.db
+        if UNREAD_WATERMARK:
+            recent, old = self._split(actions)
+        else:
+            recent, old = (), actions
+
+        with transaction.atomic(using=db):
+            # the recent actions are unread unless they have been read. Unless
+            # they have just been fetched, only the ones that were read are
+            # newly unread
+            delta = self._remove('read_actions', recent) if recent else 0
+            if fetched:
+                delta = len(recent)
+
+            through = self.unread_actions.through
+            pks = {getattr(a, 'pk', a) for a in old}
+            pks.difference_update(self._pks_in('unread_actions', pks))
+            through.objects.db_manager(db).bulk_create([
+                through(unreadtracker_id=self.pk, action_id=pk)
+                for pk in pks
+            ])
+            self._update_count(delta + len(pks))
+
+        self.cache.set(self, actions, True)
         return True
 
     def mark_read(self, action, force=False):
-        if AUTO_READ or force:
-            self.unread_actions.remove(action)
-            return True
-        return False
+        return self.bulk_mark_read((action,), force)
 
     def bulk_mark_read(self, actions, force=False):
         if AUTO_READ or force:
-            self.unread_actions.remove(*actions)
+            if actions:
+                self._mark_read(actions)
+            self.cache.set(self, actions, False)
             return True
         return False
 
+    def _mark_read(self, actions):
+        db = self._state.db
+        if UNREAD_WATERMARK:
+            recent, old = self._split(actions)
+        else:
+            recent, old = (), actions
+
+        with transaction.atomic(using=db):
+            # the recent actions are read if they are in read_actions
+            through = self.read_actions.through
+            pks = {a.pk for a in recent}
+            pks.difference_update(self._pks_in('read_actions', pks))
+            through.objects.db_manager(db).bulk_create([
+                through(unreadtracker_id=self.pk, action_id=pk)
+                for pk in pks
+            ])
+            delta = len(pks)
+
+            if old:
+                delta += self._remove('unread_actions', old)
+            self._update_count(-delta)
+
+    def mark_all_read(self):
+        """
+        Marks all the actions as read. In watermark mode, this only moves the
+        watermark and deletes the exceptions
+        """
+        db = self._state.db
+        with transaction.atomic(using=db):
+            self.unread_actions.through.objects.db_manager(db) \
+                .filter(unreadtracker_id=self.pk).delete()
+            if UNREAD_WATERMARK:
+                self.read_actions.through.objects.db_manager(db) \
+                    .filter(unreadtracker_id=self.pk).delete()
+                self.read_until = now()
+            UnreadTracker.objects.db_manager(db).filter(pk=self.pk) \
+                .update(unread_count=0, read_until=self.read_until)
+            self.unread_count = 0
+        self.cache.reset_user(self)
+
+    def _remove(self, m2m, actions):
+        """
+        Removes actions from the m2m relation, and returns the number of
+        removed actions
+        """
+        deleted, __ = getattr(self, m2m).through.objects \
+            .db_manager(self._state.db) \
+            .filter(unreadtracker_id=self.pk,
+                    action_id__in=[getattr(a, 'pk', a) for a in actions]) \
+            .delete()
+        return deleted
+
+    def _update_count(self, delta):
+        if not delta:
+            return
+        if delta > 0:
+            count = F('unread_count') + delta
+        else:
+            count = Greatest(F('unread_count') + delta, 0)
+        UnreadTracker.objects.db_manager(self._state.db) \
+                             .filter(pk=self.pk).update(unread_count=count)
+        self.unread_count = max(self.unread_count + delta, 0)
+
+    @classmethod
+    def fan_out(cls, actions, using, grouped=False):
+        """
+        If UNREAD_FANOUT is True, marks newly saved actions as unread for all
+        the users tracking them (see insert_select_batches)
+
+        :param actions: a list of (Action instance, gm2ms dict) tuples, as
+                        saved by the actions queue
+        :param grouped: if ``True``, the actions were already saved and the
+                        gm2ms dicts hold the objects grouping added to them.
+                        The users for whom the actions are already unread are
+                        skipped
+        """
+        if not TRACK_UNREAD or not UNREAD_FANOUT or UNREAD_WATERMARK:
+            # in watermark mode, new actions are unread anyway
+            return
+
+        through = cls.unread_actions.through
+        new_rows = through.objects.db_manager(using) \
+                                  .filter(action_id__in=[a.pk for a, __
+                                                         in actions])
+
+        querysets = []
+        for action, qs in Tracker.following(actions, using,
+                                            actors=not grouped):
+            if grouped:
+                qs = qs.exclude(user__unread_actions__in=new_rows.filter(
+                    action_id=action.pk
+                ).values('unreadtracker_id'))
+            querysets.append(qs.annotate(action_id=Value(action.pk,
+                                                         Action._meta.pk)))
+        if not querysets:
+            return
+
+        if grouped:
+            # only the rows inserted below are counted
+            last_pk = new_rows.aggregate(last=Max('pk'))['last']
+            if last_pk is not None:
+                new_rows = new_rows.filter(pk__gt=last_pk)
+
+        # the users that do not have an unread tracker yet
+        user_pks = set()
+        for users in union_batches([qs.filter(user__unread_actions=None)
+                                      .values_list('user_id', flat=True)
+                                    for qs in querysets]):
+            user_pks.update(users)
+        cls.objects.db_manager(using).bulk_create(
+            [cls(user_id=pk) for pk in user_pks], ignore_conflicts=True
+        )
+
+        insert_select_batches(cls.unread_actions.through,
+                              ('unreadtracker', 'action'),
+                              [qs.values_list('user__unread_actions',
+                                              'action_id')
+                               for qs in querysets],
+                              using)
+
+        # update the unread counts
+        count = new_rows.filter(unreadtracker_id=OuterRef('pk')) \
+                        .order_by().values('unreadtracker_id') \
+                        .annotate(n=Count('action_id')).values('n')
+        cls.objects.db_manager(using) \
+                   .filter(pk__in=new_rows.values('unreadtracker_id')) \
+                   .update(unread_count=F('unread_count') + Subquery(count))
+
+    @classmethod
+    def repair_counts(cls, using=None):
+        """
+        Reconciles the unread_count of the unread trackers with their unread
+        actions. Returns the number of repaired unread trackers
+        """
+        if UNREAD_WATERMARK:
+            # the unread actions can only be found from the users' feeds
+            trackers = []
+            for t in cls.objects.db_manager(using).select_related('user'):
+                actual = t.all().count()
+                if actual != t.unread_count:
+                    t.unread_count = actual
+                    trackers.append(t)
+        else:
+            trackers = list(cls.objects.db_manager(using)
+                               .annotate(actual=Count('unread_actions'))
+                               .exclude(unread_count=F('actual')))
+            for t in trackers:
+                t.unread_count = t.actual
+        cls.objects.db_manager(using).bulk_update(trackers, ['unread_count'])
+        return len(trackers)
+
 
 class TrackerBase(object):
     """
@@ -216,18 +643,103 @@ class TrackerBase(object):
             return True
         return False
 
+    @staticmethod
+    def _participants(actions, db):
+        """
+        Returns the (content type id, pk) tuples of the targets and related
+        objects of actions, in a {action pk: set} dictionary
+        """
+        pks = [a.pk for a in actions]
+        participants = defaultdict(lambda: set())
+        for attr in GM2M_ATTRS:
+            through = getattr(Action, attr).through
+            for src, ct, pk in through.objects.db_manager(db) \
+                    .filter(gm2m_src_id__in=pks) \
+                    .values_list('gm2m_src_id', 'gm2m_ct_id', 'gm2m_pk'):
+                participants[src].add((ct, pk))
+        return participants
+
+    @classmethod
+    def _match(cls, actions, trackers, db):
+        """
+        Matches actions with trackers in memory. Returns a list of
+        (action, matching trackers) tuples
+        """
+
+        # the trackers by tracked object
+        by_actor = defaultdict(lambda: [])
+        by_other = defaultdict(lambda: [])
+        if actions:
+            for t in trackers:
+                key = (t.tracked_ct_id, t.tracked_pk)
+                by_actor[key].append(t)
+                if not t.actor_only:
+                    by_other[key].append(t)
+
+        participants = cls._participants(actions, db) if by_other else {}
+
+        matches = []
+        for action in actions:
+            matching = set(by_actor.get((action.actor_ct_id, action.actor_pk),
+                                        ()))
+            for obj in participants.get(action.pk, ()):
+                matching.update(by_other.get(obj, ()))
+            matches.append((action, [t for t in matching
+                                     if not t.verbs
+                                     or action.verb in t.verbs]))
+        return matches
+
+    def needs_update(self):
+        """
+        Returns False if the unread actions do not need to be updated, because
+        the tracker has been updated less than UNREAD_REFRESH_INTERVAL seconds
+        ago or because no action has occurred since then
+        """
+        if not TRACK_UNREAD or UNREAD_FANOUT and not UNREAD_WATERMARK:
+            # with fan-out on write, the actions are marked as unread when
+            # they are saved
+            return False
+
+        updated = now()
+        if UNREAD_REFRESH_INTERVAL and self.last_updated > \
+                updated - timedelta(seconds=UNREAD_REFRESH_INTERVAL):
+            return False
+
+        try:
+            db = self._state.db
+        except AttributeError:
+            db = None
+        # only the actions on the tracked objects are looked up
+        if Action.objects.db_manager(db).tracked_by(self) \
+                 .filter(timestamp__gte=self.last_updated).exists():
+            return True
+
+        # the tracker is up to date, it is marked as updated so that
+        # UNREAD_REFRESH_INTERVAL also throttles the probes of idle trackers
+        self.last_updated = updated
+        self.save(update_fields=['last_updated'])
+        return False
+
     def update_unread(self, already_fetched=()):
         """
         Retrieves the actions having occurred after the last time the tracker
         was updated and mark them as unread (bulk-add to unread_actions).
         """
-
-        if not TRACK_UNREAD:
+        if not self.needs_update():
             return set()
+        return self._update_unread(already_fetched)
+
+    def _update_unread(self, already_fetched):
+
+        try:
+            db = self._state.db
+        except AttributeError:
+            db = None
 
         # fetch other trackers to check if the matching actions have been
         # read through another tracker
-        trackers = Tracker.objects.exclude(pk=self.pk) \
+        trackers = Tracker.objects.db_manager(db) \
+                                  .exclude(pk=self.pk) \
                                   .filter(user=self.user,
                                           last_updated__gt=self.last_updated)
 
@@ -238,24 +750,29 @@ class TrackerBase(object):
                                          level__gte=READABLE_LEVEL))
 
         fetched_elsewhere = set(already_fetched)
-        for t in trackers:
-            for action in last_actions:
-                to_mark_as_fetched_in_t = set()
-                if t.matches(action):
-                    if action.timestamp < t.last_updated:
-                        # the action has already been fetched by t, so it is
-                        # not necessary to mark it as unread now
-                        fetched_elsewhere.add(action)
-                    else:
-                        # it's the first time the action is fetched, so we
-                        # mark it as fetched in the tracker t
-                        to_mark_as_fetched_in_t.add(action)
-                # mark actions as fetched in tracker t
-                t.fetched_elsewhere.add(*to_mark_as_fetched_in_t)
+
+        through = Tracker.fetched_elsewhere.through
+        to_mark_as_fetched = []
+        for action, matching in self._match(last_actions, trackers, db):
+            for t in matching:
+                if action.timestamp < t.last_updated:
+                    # the action has already been fetched by t, so it is
+                    # not necessary to mark it as unread now
+                    fetched_elsewhere.add(action)
+                else:
+                    # it's the first time the action is fetched, so we
+                    # mark it as fetched in the tracker t
+                    to_mark_as_fetched.append(
+                        through(tracker_id=t.pk, action_id=action.pk)
+                    )
+
+        # mark actions as fetched in the other trackers
+        through.objects.db_manager(db).bulk_create(to_mark_as_fetched,
+                                                   ignore_conflicts=True)
 
         last_actions.difference_update(fetched_elsewhere)
 
-        self.user.unread_actions.mark_unread(*last_actions)
+        self.user.unread_actions._mark_unread(last_actions, fetched=True)
 
         self.last_updated = now()
         self.save()
@@ -292,12 +809,171 @@ class Tracker(models.Model, TrackerBase):
     last_updated = models.DateTimeField(default=now)
     fetched_elsewhere = models.ManyToManyField(Action, related_name='fetched+')
 
+    class Meta:
+        indexes = [models.Index(fields=['tracked_ct', 'tracked_pk'])]
+
     def update_unread(self):
-        last_actions = super(Tracker, self) \
-                       .update_unread(self.fetched_elsewhere.all())
+        if not self.needs_update():
+            return set()
+        last_actions = self._update_unread(self.fetched_elsewhere.all())
         self.fetched_elsewhere.clear()
         return last_actions
 
+    @classmethod
+    def with_tracker_count(cls, trackers):
+        """
+        Annotates a trackers queryset with the number of trackers following
+        the same object as each tracker, as ``tracker_count``
+        """
+        count = cls.objects.filter(tracked_ct=OuterRef('tracked_ct'),
+                                   tracked_pk=OuterRef('tracked_pk')) \
+                           .order_by().values('tracked_ct') \
+                           .annotate(count=Count('pk')).values('count')
+        return trackers.annotate(
+            tracker_count=Subquery(count, output_field=models.IntegerField())
+        )
+
+    @classmethod
+    def crowded(cls, trackers):
+        """
+        Keeps the trackers following objects that have too many trackers for
+        their actions to be stored in the inboxes (see INBOX_MAX_TRACKERS)
+        """
+        if INBOX_MAX_TRACKERS is None:
+            return trackers.none()
+        return cls.with_tracker_count(trackers) \
+                  .filter(tracker_count__gt=INBOX_MAX_TRACKERS)
+
+    @classmethod
+    def uncrowded(cls, trackers):
+        """
+        Keeps the trackers following objects whose actions are stored in the
+        inboxes (see INBOX_MAX_TRACKERS). The trackers of model classes are
+        never crowded
+        """
+        if INBOX_MAX_TRACKERS is None:
+            return trackers
+        return cls.with_tracker_count(trackers) \
+                  .filter(Q(tracker_count__lte=INBOX_MAX_TRACKERS) |
+                          Q(tracked_pk__isnull=True))
+
+    @classmethod
+    def following(cls, actions, using, exclude=(), actors=True):
+        """
+        Yields (action, trackers queryset) tuples for the readable actions
+        followed by trackers
+
+        :param actions: a list of (Action instance, gm2ms dict) tuples, as
+                        saved by the actions queue
+        :param exclude: (content type id, pk) tuples of objects whose trackers
+                        should be ignored. The trackers of their model are not
+        :param actors: if ``False``, only the trackers of the targets and
+                       related objects are considered
+        """
+        for action, gm2ms in actions:
+            if action.level < READABLE_LEVEL:
+                continue
+
+            q = Q()
+            others = Q()
+            for obj_ct, obj_pk, actor in cls._action_objects(action, gm2ms):
+                if actor and not actors:
+                    continue
+                # the trackers of the object's model, and of the object
+                obj_q = Q(tracked_ct_id=obj_ct, tracked_pk__isnull=True)
+                if (obj_ct, obj_pk) not in exclude:
+                    obj_q |= Q(tracked_ct_id=obj_ct, tracked_pk=obj_pk)
+                if actor:
+                    q |= obj_q
+                else:
+                    others |= obj_q
+            if others:
+                q |= Q(actor_only=False) & others
+            if not q:
+                continue
+
+            yield action, follows_verb(
+                cls.objects.db_manager(using).filter(q),
+                Value(';%s;' % action.verb)
+            ).order_by()
+
+    @staticmethod
+    def _action_objects(action, gm2ms):
+        """
+        Yields (content type id, pk, is actor) tuples for the objects involved
+        in an action
+        """
+        if action.actor_ct_id is not None:
+            yield action.actor_ct_id, action.actor_pk, True
+        for attr in GM2M_ATTRS:
+            for obj in gm2ms[attr]:
+                if obj.pk is not None:
+                    yield get_content_type(obj).pk, str(obj.pk), False
+
+    @classmethod
+    def bulk_update_unread(cls, user, trackers):
+        """
+        Marks as unread the actions that have occurred since the trackers
+        were updated, for all the trackers owned by a user at once.
+        ``trackers`` must contain all the trackers owned by the user.
+
+        Returns the set of the actions marked as unread
+        """
+
+        trackers = list(trackers)
+        if not TRACK_UNREAD or UNREAD_FANOUT and not UNREAD_WATERMARK \
+        or not trackers:
+            return set()
+
+        db = trackers[0]._state.db
+        updated = now()
+
+        if UNREAD_REFRESH_INTERVAL and min(t.last_updated for t in trackers) \
+                > updated - timedelta(seconds=UNREAD_REFRESH_INTERVAL):
+            # all the trackers have been updated recently
+            return set()
+
+        # the actions that occurred since the last time any tracker was
+        # updated, in one query which size does not depend on the number of
+        # trackers
+        owned = cls.objects.db_manager(db).filter(user=user)
+        last_actions = set(Action.objects.db_manager(db).tracked_by_any(
+            owned, since_updated=True, level__gte=READABLE_LEVEL
+        ))
+        if not last_actions:
+            # no action on the tracked objects since the trackers were
+            # updated. They are marked as updated all the same, so that
+            # UNREAD_REFRESH_INTERVAL also throttles the probes of idle feeds
+            owned.update(last_updated=updated)
+            for t in trackers:
+                t.last_updated = updated
+            return set()
+
+        # the actions marked as fetched in any tracker have already been
+        # marked as unread
+        through = cls.fetched_elsewhere.through
+        fetched = set(through.objects.db_manager(db)
+                             .filter(tracker_id__in=[t.pk for t in trackers],
+                                     action_id__in={a.pk for a in last_actions})
+                             .values_list('action_id', flat=True))
+
+        new_actions = set()
+        for action, matching in cls._match(last_actions, trackers, db):
+            if action.pk in fetched:
+                continue
+            if all(action.timestamp >= t.last_updated for t in matching):
+                # no tracker has already fetched the action
+                new_actions.add(action)
+
+        user.unread_actions._mark_unread(new_actions, fetched=True)
+
+        owned.update(last_updated=updated)
+        through.objects.db_manager(db).filter(tracker__user=user).delete()
+        for t in trackers:
+            t.last_updated = updated
+
+        return new_actions
+
 
 class TempTracker(TrackerBase):
     """
@@ -323,14 +999,186 @@ class TempTracker(TrackerBase):
         self.tracked_ct_id = self.tracked_ct.pk
         self.tracked_pk = tracked.pk
 
-    def save(self):
+    def save(self, *args, **kwargs):
         # mocks django model, do nothing
         pass
 
 
-class DelItemsRegistry(local):
+class InboxEntry(models.Model):
+    """
+    An action in a user's feed, when the INBOX setting is True. The entries
+    are created when the actions are saved or when trackers are created, and
+    deleted when trackers are deleted
+    """
+
+    user = models.ForeignKey(USER_MODEL, on_delete=models.CASCADE,
+                             related_name='+')
+    action = models.ForeignKey(Action, on_delete=models.CASCADE,
+                               related_name='inbox_entries')
+    #: A copy of the action's timestamp, to retrieve a user's feed in order
+    #: from the index
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'action')
+        indexes = [models.Index(fields=['user', '-timestamp'])]
+
+    @classmethod
+    def fan_out(cls, actions, using, grouped=False):
+        """
+        Adds newly saved actions to the inboxes of the users tracking them
+        (see insert_select_batches)
+
+        :param actions: a list of (Action instance, gm2ms dict) tuples, as
+                        saved by the actions queue
+        :param grouped: if ``True``, the actions were already saved and the
+                        gm2ms dicts hold the objects grouping added to them.
+                        The users who already have the actions in their inbox
+                        are skipped
+        """
+        if not INBOX:
+            return
+
+        # the actions involving crowded objects are retrieved at read time
+        # for the users tracking these objects
+        crowded = set()
+        if INBOX_MAX_TRACKERS is not None:
+            # one condition per content type, so that the size of the query
+            # does not depend on the number of objects
+            pks = defaultdict(set)
+            for action, gm2ms in actions:
+                for obj_ct, obj_pk, __ in Tracker._action_objects(action,
+                                                                  gm2ms):
+                    pks[obj_ct].add(obj_pk)
+            q = Q()
+            for obj_ct, obj_pks in pks.items():
+                q |= Q(tracked_ct_id=obj_ct, tracked_pk__in=obj_pks)
+            if q:
+                crowded = set(
+                    Tracker.crowded(Tracker.objects.db_manager(using)
+                                           .filter(q))
+                           .values_list('tracked_ct_id', 'tracked_pk')
+                )
+
+        querysets = []
+        for action, qs in Tracker.following(actions, using, crowded,
+                                            actors=not grouped):
+            if grouped:
+                qs = qs.exclude(user__in=cls.objects.db_manager(using)
+                                            .filter(action=action.pk)
+                                            .values('user'))
+            querysets.append(
+                qs.annotate(action_id=Value(action.pk, Action._meta.pk),
+                            action_timestamp=Value(action.timestamp,
+                                                   models.DateTimeField()))
+                  .values_list('user_id', 'action_id', 'action_timestamp')
+            )
+
+        insert_select_batches(cls, ('user', 'action', 'timestamp'),
+                              querysets, using)
+
+    @classmethod
+    def backfill(cls, trackers):
+        """
+        Adds the actions followed by trackers to their users' inboxes, if
+        they are not there already (see insert_select_batches)
+
+        :param trackers: a Tracker queryset. The trackers of crowded objects
+                         are ignored
+        """
+        if not INBOX:
+            return
+
+        db = trackers.db
+        user_field = Tracker._meta.get_field('user').target_field
+        querysets = []
+        for t in Tracker.uncrowded(trackers):
+            # only annotations are selected, so that the columns are in the
+            # order of the inserted fields
+            querysets.append(
+                Action.objects.db_manager(db)
+                      .filter(Action.objects.tracker_q(t),
+                              level__gte=READABLE_LEVEL)
+                      .exclude(inbox_entries__user=t.user_id)
+                      .annotate(user_id=Value(t.user_id, user_field),
+                                action_id=F('pk'),
+                                action_timestamp=F('timestamp'))
+                      .values_list('user_id', 'action_id', 'action_timestamp')
+                      .order_by()
+            )
+        insert_select_batches(cls, ('user', 'action', 'timestamp'),
+                              querysets, db)
+
+    @classmethod
+    def uncrowded_by(cls, trackers):
+        """
+        Returns the (content type id, pk) tuples of the objects that are not
+        crowded anymore once trackers are deleted, as they have one tracker
+        more than INBOX_MAX_TRACKERS. Must be called before the deletion
+
+        :param trackers: a Tracker queryset
+        """
+        if not INBOX or INBOX_MAX_TRACKERS is None:
+            return []
+
+        return list(Tracker.with_tracker_count(trackers)
+                           .filter(tracker_count=INBOX_MAX_TRACKERS + 1)
+                           .values_list('tracked_ct_id', 'tracked_pk'))
+
+    @classmethod
+    def uncrowd(cls, objs, using=None):
+        """
+        Adds the actions involving objects that are not crowded anymore to the
+        inboxes of their trackers
+
+        :param objs: (content type id, pk) tuples, as returned by
+                     ``uncrowded_by``
+        """
+        if not objs:
+            return
+
+        # one condition per content type, so that the size of the query
+        # does not depend on the number of objects
+        pks = defaultdict(set)
+        for obj_ct, obj_pk in objs:
+            pks[obj_ct].add(obj_pk)
+        q = Q()
+        for obj_ct, obj_pks in pks.items():
+            q |= Q(tracked_ct_id=obj_ct, tracked_pk__in=obj_pks)
+        cls.backfill(Tracker.objects.db_manager(using).filter(q))
+
+    @classmethod
+    def rebuild(cls, using=None):
+        """
+        Rebuilds all the inboxes from the trackers, e.g. after the INBOX
+        setting has been enabled
+
+        :returns: the number of entries in the inboxes
+        """
+        entries = cls.objects.db_manager(using)
+        entries.all().delete()
+        cls.backfill(Tracker.objects.db_manager(using).all())
+        return entries.count()
+
+    @classmethod
+    def prune(cls, user, using=None):
+        """
+        Removes the actions that are not followed by any of the user's
+        trackers from the user's inbox
+        """
+        if not INBOX:
+            return
+
+        trackers = Tracker.objects.db_manager(using).filter(user=user)
+        cls.objects.db_manager(using).filter(user=user).exclude(
+            action__in=Action.objects.db_manager(using)
+                                     .tracked_by_any(trackers).values('pk')
+        ).delete()
+
+
+class DelItemsRegistry(RequestLocal):
 
-    def __init__(self):
+    def initialize(self):
         self.items = []
 
     def add(self, instance, del_item):
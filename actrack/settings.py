@@ -12,8 +12,21 @@ DEFAULT_HANDLER = 'actrack.ActionHandler'
 
 TRACK_UNREAD = True
 AUTO_READ = True
+UNREAD_WATERMARK = False
+UNREAD_REFRESH_INTERVAL = 0
+UNREAD_FANOUT = False
+INBOX = False
+INBOX_MAX_TRACKERS = None
+FEED_CACHE = None
+FEED_CACHE_TIMEOUT = 300
 GROUPING_DELAY = 0
 
+SAVE_WORKERS = 0
+SAVE_WORKERS_BACKLOG = 16
+SAVE_ON_COMMIT = False
+QUEUE_MAX_SIZE = 0
+QUEUE_MAX_AGE = 0
+
 LEVELS = {
     'NULL': 0,
     'DEBUG': 10,
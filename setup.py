@@ -45,7 +45,7 @@ setup(
     ],
     packages=find_packages(exclude=('tests',)),
     install_requires=(
-        'django>=2.2',
+        'django>=2.2,<5.2',
         'django-gm2m>=1.0',
         'jsonfield',
     ),
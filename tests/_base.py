@@ -8,7 +8,7 @@ __test__ = False
 __unittest = True
 
 
-class TestCase(test.TestCase):
+class TestCaseMixin(object):
 
     @property
     def user_model(self):
@@ -24,3 +24,11 @@ class TestCase(test.TestCase):
     @staticmethod
     def save_queue():
         save_queue(None)
+
+
+class TestCase(TestCaseMixin, test.TestCase):
+    pass
+
+
+class TransactionTestCase(TestCaseMixin, test.TransactionTestCase):
+    pass
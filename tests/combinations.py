@@ -1,3 +1,4 @@
+from actrack.actions_queue import thread_actions_queue
 from actrack.models import Action
 
 from ._base import TestCase
@@ -15,3 +16,29 @@ class CombiningTests(TestCase):
         self.save_queue()
 
         self.assertEqual(Action.objects.count(), 1)
+
+    def test_combination_reversed(self):
+        self.log(self.user0, 'my_included_action')
+        self.log(self.user0, 'my_included_action')
+        self.log(self.user0, 'my_all_inclusive_action')
+
+        # the queued included actions have been removed
+        self.assertListEqual(
+            [kws['verb'] for __, kws in thread_actions_queue],
+            ['my_all_inclusive_action']
+        )
+
+        self.save_queue()
+        self.assertEqual(Action.objects.count(), 1)
+
+    def test_no_combination_other_actor(self):
+        user1 = self.user_model.objects.create(username='user1')
+        self.log(self.user0, 'my_included_action')
+        self.log(user1, 'my_all_inclusive_action')
+        self.log(self.user0, 'my_all_inclusive_action')
+        self.log(user1, 'my_included_action')
+        self.save_queue()
+
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertEqual(Action.objects.filter(
+            verb='my_all_inclusive_action').count(), 2)
@@ -0,0 +1,62 @@
+"""
+Isolation of the actions queues of concurrent ASGI requests
+"""
+
+import asyncio
+
+from django.core.signals import request_started
+
+from ._base import TestCase, TransactionTestCase
+
+from actrack.actions_queue import thread_actions_queue
+from actrack.models import Action
+
+from .app.models import Project
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class ContextTests(TestCase):
+
+    def setUp(self):
+        self.user = self.user_model.objects.create(username='user')
+        self.project = Project.objects.create()
+
+    def test_isolation(self):
+
+        async def request(verb):
+            request_started.send(None, scope={})
+            self.log(self.user, verb, related=self.project)
+            # let the other request log its action
+            await asyncio.sleep(0)
+            return [kws['verb'] for __, kws in thread_actions_queue]
+
+        async def requests():
+            return await asyncio.gather(request('created'),
+                                        request('modified'))
+
+        self.assertListEqual(run(requests()), [['created'], ['modified']])
+        self.assertEqual(len(thread_actions_queue), 0)
+
+
+class AsyncSaveTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = self.user_model.objects.create(username='user')
+        self.project = Project.objects.create()
+
+    def test_asave(self):
+
+        async def request():
+            request_started.send(None, scope={})
+            self.log(self.user, 'created', related=self.project)
+            await thread_actions_queue.asave()
+
+        run(request())
+        self.assertEqual(Action.objects.count(), 1)
@@ -3,14 +3,18 @@ Logs actions using the actrack.log signal sending function and save them
 using the request_finished signal
 """
 
+from threading import BoundedSemaphore
+
 from django.core.signals import request_finished
 
-from ._base import TestCase
+from ._base import TestCase, TransactionTestCase
 
 import actrack
+from actrack import actions_queue
 from actrack.models import Action
+from actrack.gfk import get_content_type
 
-from .app.models import Project
+from .app.models import Project, Task
 from .app.action_handlers import MyActionHandler
 
 
@@ -43,3 +47,134 @@ class CreationTests(TestCase):
         self.log(self.user, 'my_action', commit=True)
         my_action = Action.objects.all()[0]
         self.assertTrue(isinstance(my_action.handler, MyActionHandler))
+
+    def test_bulk_save(self):
+        task = Task.objects.create(project=self.project)
+        for verb in ('created', 'modified', 'validated'):
+            self.log(self.user, verb, targets=task, related=self.project)
+
+        # warm up the content types cache
+        get_content_type(task)
+        get_content_type(self.project)
+
+        # one insert per action (the primary keys cannot be retrieved from a
+        # bulk insert with sqlite) and one insert per through model, in a
+        # savepoint as the test case runs in a transaction
+        with self.assertNumQueries(7):
+            self.save_queue()
+
+        self.assertEqual(Action.objects.count(), 3)
+        for action in Action.objects.all():
+            self.assertListEqual(list(action.targets.all()), [task])
+            self.assertListEqual(list(action.related.all()), [self.project])
+
+    def test_log_many(self):
+        tasks = [Task.objects.create(project=self.project) for __ in range(3)]
+
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        actrack.signals.log_action.connect(receiver)
+        try:
+            actrack.log_many(
+                [{'actor': self.user, 'verb': 'created', 'targets': task,
+                  'related': self.project} for task in tasks] +
+                [{'actor': self.user, 'verb': 'my_action', 'my_data': 0}]
+            )
+        finally:
+            actrack.signals.log_action.disconnect(receiver)
+
+        # the actions are queued without sending the signal
+        self.assertListEqual(received, [])
+        self.assertEqual(len(actions_queue.thread_actions_queue), 4)
+
+        # the actions are grouped as they have the same related object
+        self.save_queue()
+
+        created_action = Action.objects.get(verb='created')
+        self.assertSetEqual(set(created_action.targets.all()), set(tasks))
+        my_action = Action.objects.get(verb='my_action')
+        self.assertEqual(my_action.actor, self.user)
+        self.assertEqual(my_action.data['my_data'], 0)
+        self.assertTrue(isinstance(my_action.handler, MyActionHandler))
+
+
+class BackgroundCreationTests(TransactionTestCase):
+
+    def setUp(self):
+        actions_queue.SAVE_WORKERS = 1
+        self.user = self.user_model.objects.create(username='user')
+        self.project = Project.objects.create()
+
+    def tearDown(self):
+        actions_queue.actions_saver.shutdown()
+        actions_queue.SAVE_WORKERS = 0
+
+    def test_background(self):
+        actrack.log(self.user, 'tests', related=self.project)
+        request_finished.send(None)
+
+        # the queue has been handed over to the worker
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+        # wait for the worker to save the actions
+        actions_queue.actions_saver.shutdown()
+
+        self.assertEqual(Action.objects.count(), 1)
+        created_action = Action.objects.get()
+        self.assertEqual(list(created_action.related.all()), [self.project])
+        self.assertEqual(created_action.actor, self.user)
+
+    def test_saturated(self):
+        # start the workers and occupy all the slots
+        saver = actions_queue.actions_saver
+        saver.submit(actions_queue.thread_actions_queue)
+        saver.slots = BoundedSemaphore(1)
+        saver.slots.acquire()
+
+        actrack.log(self.user, 'tests', related=self.project)
+        request_finished.send(None)
+
+        # the queue has been saved synchronously
+        self.assertEqual(Action.objects.count(), 1)
+
+
+class AutoSaveTests(TestCase):
+
+    def setUp(self):
+        self.user = self.user_model.objects.create(username='user')
+        self.project = Project.objects.create()
+        actions_queue.queue_stats.reset()
+
+    def tearDown(self):
+        actions_queue.QUEUE_MAX_SIZE = 0
+        actions_queue.QUEUE_MAX_AGE = 0
+
+    def test_max_size(self):
+        actions_queue.QUEUE_MAX_SIZE = 3
+        for verb in ('created', 'modified', 'validated'):
+            self.log(self.user, verb, related=self.project)
+
+        # the queue has been saved when the 3rd action was added
+        self.assertEqual(Action.objects.count(), 3)
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+        stats = actions_queue.queue_stats.as_dict()
+        self.assertEqual(stats['saves'], 1)
+        self.assertEqual(stats['auto_saves'], 1)
+        self.assertEqual(stats['created'], 3)
+        self.assertEqual(stats['max_size'], 3)
+
+    def test_max_age(self):
+        actions_queue.QUEUE_MAX_AGE = 60
+        self.log(self.user, 'created', related=self.project)
+        self.assertEqual(Action.objects.count(), 0)
+
+        # make as if the first action was queued 2 minutes ago
+        actions_queue.thread_actions_queue.started -= 120
+        self.log(self.user, 'modified', related=self.project)
+
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertEqual(actions_queue.queue_stats.auto_saves, 1)
@@ -1,3 +1,7 @@
+from datetime import timedelta
+
+from django.utils.timezone import now
+
 from actrack import handler
 from actrack.models import Action
 
@@ -45,3 +49,105 @@ class GroupingTests(TestCase):
         self.log_actions(grouping_delay=-1)
         # no grouping, we should have 4 logged actions
         self.assertEqual(Action.objects.count(), 4)
+
+    def test_groups_window(self):
+        tstamp = now()
+        self.log(self.user0, 'created', targets=self.task1,
+                 related=self.project, timestamp=tstamp - timedelta(0, 120))
+        self.log(self.user0, 'created', targets=self.task2,
+                 related=self.project, timestamp=tstamp - timedelta(0, 30))
+        self.log(self.user0, 'created', targets=self.task3,
+                 related=self.project, timestamp=tstamp)
+        self.save_queue()
+
+        # the 1st action is out of the grouping window of the other ones
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertSetEqual(
+            set(Action.objects.all()[0].targets.all()),
+            {self.task2, self.task3}
+        )
+
+    def test_groups_buckets(self):
+        user1 = self.user_model.objects.create(username='user1')
+        for task in (self.task1, self.task2, self.task3):
+            self.log(self.user0, 'created', targets=task, related=self.project)
+            self.log(user1, 'created', targets=task, related=self.project)
+            self.log(self.user0, 'modified', targets=task,
+                     related=self.project)
+        self.save_queue()
+
+        # one action per verb and actor
+        self.assertEqual(Action.objects.count(), 3)
+        for action in Action.objects.all():
+            self.assertSetEqual(set(action.targets.all()),
+                                {self.task1, self.task2, self.task3})
+
+    def test_groups_merged(self):
+        project2 = Project.objects.create(name='project2')
+        for delay in (60, 0):
+            Action.objects.all().delete()
+            self.log(self.user0, 'created', targets=self.task1,
+                     related=self.project, grouping_delay=delay)
+            self.log(self.user0, 'created', targets=[self.task1, self.task2],
+                     related=project2, grouping_delay=delay)
+            self.log(self.user0, 'created', targets=self.task2,
+                     related=self.project, grouping_delay=delay)
+            self.save_queue()
+
+            # the 3rd action is merged with the 1st one, that then has the
+            # same targets as the 2nd one
+            self.assertEqual(Action.objects.count(), 1)
+            action = Action.objects.get()
+            self.assertSetEqual(set(action.targets.all()),
+                                {self.task1, self.task2})
+            self.assertSetEqual(set(action.related.all()),
+                                {self.project, project2})
+
+    def test_groups_saved(self):
+        self.log_actions()
+
+        task4 = Task.objects.create(name='task4', project=self.project)
+        task5 = Task.objects.create(name='task5', project=self.project)
+        self.log(self.user0, 'created', targets=task4, related=self.project)
+        self.log(self.user0, 'created', targets=task5, related=self.project)
+
+        # 1 query to retrieve the saved actions, 5 to prefetch their targets
+        # and related objects (through and target models), and the grouped
+        # action update and targets insertion in a savepoint
+        with self.assertNumQueries(10):
+            self.save_queue()
+
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertSetEqual(
+            set(self.project.actions.as_related()[0].targets.all()),
+            {self.task1, self.task2, self.task3, task4, task5}
+        )
+
+    def test_fingerprints(self):
+        self.log_actions()
+        action = self.project.actions.as_related()[0]
+        targets_hash, related_hash = action.targets_hash, action.related_hash
+        self.assertIsNotNone(targets_hash)
+
+        task4 = Task.objects.create(name='task4', project=self.project)
+        self.log(self.user0, 'created', targets=task4, related=self.project)
+        self.save_queue()
+
+        # the grouped action targets have changed, not its related objects
+        action = Action.objects.get(pk=action.pk)
+        self.assertNotEqual(action.targets_hash, targets_hash)
+        self.assertEqual(action.related_hash, related_hash)
+
+    def test_groups_saved_fingerprints(self):
+        self.log_actions()
+        project2 = Project.objects.create(name='project2')
+        task4 = Task.objects.create(name='task4', project=project2)
+        self.log(self.user0, 'created', targets=task4, related=project2)
+
+        # the saved actions have neither the same targets nor the same
+        # related objects, they are not even retrieved: 1 query to look for
+        # them and the creation queries in a savepoint
+        with self.assertNumQueries(6):
+            self.save_queue()
+
+        self.assertEqual(Action.objects.count(), 3)
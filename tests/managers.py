@@ -2,14 +2,23 @@
 Testing the correct behaviour of managers and managers functions
 """
 
+import warnings
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
 import actrack
-from actrack.models import Action
+from actrack import models, cache
+from actrack.helpers import encode_cursor
+from actrack.managers import inst
+from actrack.models import Action, InboxEntry
 
-from ._base import TestCase
+from ._base import TestCase, TransactionTestCase
 from .app.models import Project, Task
 
 
-class ManagerTests(TestCase):
+class ManagerFixtures(object):
 
     def setUp(self):
         User = self.user_model
@@ -32,6 +41,10 @@ class ManagerTests(TestCase):
         self.save_queue()
 
 
+class ManagerTests(ManagerFixtures, TestCase):
+    pass
+
+
 class ActionManagerTests(ManagerTests):
 
     def test_get_queryset(self):
@@ -43,6 +56,16 @@ class ActionManagerTests(ManagerTests):
         self.assertEqual(self.task2.actions.all().count(), 0)
         self.assertEqual(self.task3.actions.all().count(), 0)
 
+    def test_no_duplicates(self):
+        self.log(self.user1, 'linked', targets=[self.project, self.task1],
+                 related=self.project, commit=True)
+        qs = self.project.actions.all()
+        self.assertNotIn('DISTINCT', str(qs.query))
+        self.assertEqual(len(qs), 3)
+        self.assertEqual(len(self.user2.actions.feed()), 3)
+        tracker = self.user2.trackers.owned().get()
+        self.assertEqual(len(Action.objects.tracked_by(tracker)), 3)
+
     def test_as_actor(self):
         self.assertEqual(self.user0.actions.as_actor().count(), 0)
         self.assertEqual(self.user1.actions.as_actor().count(), 2)
@@ -67,6 +90,313 @@ class ActionManagerTests(ManagerTests):
         self.assertEqual(self.user1.actions.feed(include_own=True).count(), 2)
         self.assertEqual(self.user2.actions.feed().count(), 2)
 
+    def test_feed_query_size(self):
+        size = len(str(self.user0.actions.feed().query))
+        actrack.track(self.user0, [self.task1, self.task2, self.task3],
+                      actor_only=False, verbs=['created'])
+        self.assertEqual(len(str(self.user0.actions.feed().query)), size)
+        self.assertEqual(self.user0.actions.feed().count(), 2)
+
+    def test_verbs_case(self):
+        user = self.user_model.objects.create(username='user3')
+        actrack.track(user, self.task2, actor_only=False, verbs=['created'])
+        self.log(self.user1, 'CREATED', targets=self.task2, commit=True)
+        tracker = user.trackers.get()
+        # the verbs are matched exactly, LIKE ignores case on some databases
+        self.assertEqual(Action.objects.tracked_by(tracker).count(), 0)
+        self.assertEqual(user.actions.feed().count(), 0)
+        self.log(self.user1, 'created', targets=self.task2, commit=True)
+        self.assertEqual(Action.objects.tracked_by(tracker).count(), 1)
+        self.assertEqual(user.actions.feed().count(), 1)
+
+
+class PaginationTests(ManagerTests):
+
+    def setUp(self):
+        super(PaginationTests, self).setUp()
+        for verb in ('started', 'paused', 'resumed'):
+            self.log(self.user1, verb, targets=self.task2,
+                     related=self.project)
+        self.save_queue()
+        # two actions with the same timestamp
+        Action.objects.filter(verb__in=('paused', 'resumed')) \
+                      .update(timestamp=now())
+
+    def get_pages(self, qs, size):
+        actions, cursor = qs.page(size=size)
+        pages = [actions]
+        while cursor is not None:
+            actions, cursor = qs.page(cursor, size=size)
+            pages.append(actions)
+        return pages
+
+    def test_feed_pages(self):
+        pages = self.get_pages(self.user0.actions.feed(), 2)
+        self.assertListEqual([len(p) for p in pages], [2, 2, 1])
+        actions = sum(pages, [])
+        self.assertListEqual(
+            actions, list(Action.objects.order_by('-timestamp', '-pk'))
+        )
+
+    def test_instance_pages(self):
+        pages = self.get_pages(self.project.actions.all(), 3)
+        self.assertListEqual([len(p) for p in pages], [3, 2])
+        self.assertEqual(len(set(sum(pages, []))), 5)
+
+    def test_insert_between_pages(self):
+        actions, cursor = self.project.actions.all().page(size=2)
+        self.log(self.user1, 'deleted', targets=self.project, commit=True)
+        next_actions, cursor = self.project.actions.all().page(cursor, size=2)
+        self.assertFalse(set(actions) & set(next_actions))
+        self.assertNotIn(Action.objects.get(verb='deleted'), next_actions)
+
+    def test_feed_since(self):
+        actions, cursor = self.user0.actions.feed_since()
+        self.assertListEqual(actions, [])
+
+        with self.assertNumQueries(1):
+            # only the last timestamp is checked
+            self.assertTupleEqual(self.user0.actions.feed_since(cursor),
+                                  ([], cursor))
+
+        self.log(self.user1, 'deleted', targets=self.task2, commit=True)
+        deleted = Action.objects.get(verb='deleted')
+        actions, cursor = self.user0.actions.feed_since(cursor)
+        self.assertListEqual(actions, [deleted])
+        self.assertListEqual(self.user0.actions.feed_since(cursor)[0], [])
+
+        # the cursors of the pages can also be used
+        first, __ = self.user0.actions.feed().page(size=1)
+        self.assertListEqual(
+            self.user0.actions.feed_since(
+                encode_cursor(first[0].timestamp, first[0].pk)
+            )[0], []
+        )
+
+    def test_feed_since_late(self):
+        late_timestamp = now()
+        __, cursor = self.user0.actions.feed_since()
+        self.log(self.user1, 'created', targets=self.task1, commit=True)
+        actions, cursor = self.user0.actions.feed_since(cursor)
+        self.assertEqual(len(actions), 1)
+
+        # an action which is saved after the cursor has moved past its
+        # timestamp is not returned, but is still in the feed
+        self.log(self.user1, 'deleted', targets=self.task2,
+                 timestamp=late_timestamp, commit=True)
+        self.assertTupleEqual(self.user0.actions.feed_since(cursor),
+                              ([], cursor))
+        self.assertIn(Action.objects.get(verb='deleted'),
+                      self.user0.actions.feed())
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            self.project.actions.all().page('invalid')
+
+
+class FeedCacheTests(ManagerFixtures, TransactionTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(FeedCacheTests, cls).setUpClass()
+        cache.FEED_CACHE = 'default'
+
+    @classmethod
+    def tearDownClass(cls):
+        cache.FEED_CACHE = None
+        super(FeedCacheTests, cls).tearDownClass()
+
+    def setUp(self):
+        super(FeedCacheTests, self).setUp()
+        cache.feed_cache.cache.clear()
+
+    def test_cached(self):
+        actions, cursor = self.user0.actions.feed_page(size=1)
+        with self.assertNumQueries(0):
+            self.assertTupleEqual(self.user0.actions.feed_page(size=1),
+                                  (actions, cursor))
+        # another page is not cached yet. The trackers are probed for unread
+        # actions and marked as updated before the page is retrieved
+        with self.assertNumQueries(4):
+            self.user0.actions.feed_page(cursor, size=1)
+
+    def test_invalidate_actions(self):
+        self.assertEqual(len(self.user0.actions.feed_page()[0]), 2)
+
+        # an action that is not tracked by user0
+        self.log(self.user2, 'created', targets=self.task3, commit=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.user0.actions.feed_page()[0]), 2)
+
+        self.log(self.user1, 'deleted', targets=self.task3, commit=True)
+        self.assertEqual(len(self.user0.actions.feed_page()[0]), 3)
+
+    def test_invalidate_on_commit(self):
+        self.assertEqual(len(self.user0.actions.feed_page()[0]), 2)
+
+        # the feed is invalidated once the saved action is visible
+        with transaction.atomic():
+            self.log(self.user1, 'deleted', targets=self.task3, commit=True)
+            with self.assertNumQueries(0):
+                self.assertEqual(len(self.user0.actions.feed_page()[0]), 2)
+        self.assertEqual(len(self.user0.actions.feed_page()[0]), 3)
+
+    def test_invalidate_trackers(self):
+        self.assertEqual(len(self.user1.actions.feed_page()[0]), 0)
+        actrack.track(self.user1, self.project, actor_only=False)
+        self.assertEqual(len(self.user1.actions.feed_page()[0]), 2)
+        actrack.untrack(self.user1, self.project)
+        self.assertEqual(len(self.user1.actions.feed_page()[0]), 0)
+
+
+class InboxTests(ActionManagerTests):
+
+    @classmethod
+    def setUpClass(cls):
+        super(InboxTests, cls).setUpClass()
+        models.INBOX = inst.INBOX = True
+
+    @classmethod
+    def tearDownClass(cls):
+        models.INBOX = inst.INBOX = False
+        super(InboxTests, cls).tearDownClass()
+
+    def test_fan_out(self):
+        self.assertEqual(InboxEntry.objects.filter(user=self.user0).count(), 2)
+        self.assertEqual(InboxEntry.objects.filter(user=self.user1).count(), 0)
+        self.assertEqual(InboxEntry.objects.filter(user=self.user2).count(), 2)
+
+    def test_feed_order(self):
+        self.assertListEqual(list(self.user0.actions.feed()),
+                             list(Action.objects.order_by('-timestamp')))
+
+    def test_backfill(self):
+        actrack.track(self.user1, self.task1, actor_only=False)
+        self.assertSetEqual(set(self.user1.actions.feed()),
+                            set(self.task1.actions.all()))
+
+        # changing the tracker's options does not duplicate the entries
+        actrack.track(self.user1, self.task1, actor_only=False,
+                      verbs=['created'])
+        self.assertEqual(self.user1.actions.feed().count(), 1)
+
+    def test_prune(self):
+        actrack.track(self.user0, self.project, actor_only=False)
+        actrack.untrack(self.user0, self.user1)
+        # the actions are still tracked through the project
+        self.assertEqual(self.user0.actions.feed().count(), 2)
+
+        actrack.track(self.user0, self.project, actor_only=False,
+                      verbs=['deleted'])
+        self.assertEqual(self.user0.actions.feed().count(), 0)
+
+        actrack.untrack(self.user2, self.project)
+        self.assertEqual(self.user2.actions.feed().count(), 0)
+        self.assertFalse(InboxEntry.objects.filter(user=self.user2).exists())
+
+    def test_fan_out_model(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            actrack.track(self.user1, Task, actor_only=False)
+        self.log(self.user0, 'created', targets=self.task2, commit=True)
+
+        # the actions on any task are followed
+        self.assertSetEqual(
+            set(self.user1.actions.feed()),
+            {self.task1.actions.get(), self.task2.actions.get()}
+        )
+
+    def test_fan_out_grouped(self):
+        actrack.track(self.user1, self.task2, actor_only=False)
+        self.log(self.user1, 'created', targets=self.task2,
+                 related=self.project, grouping_delay=60, commit=True)
+
+        # the action is grouped with a saved one, that is added to the inbox
+        # of the users tracking the new target
+        action = self.task2.actions.get()
+        self.assertSetEqual(set(action.targets.all()),
+                            {self.task1, self.task2})
+        self.assertListEqual(list(self.user1.actions.feed()), [action])
+        self.assertEqual(InboxEntry.objects.filter(user=self.user0).count(), 2)
+
+    def test_rebuild(self):
+        InboxEntry.objects.all().delete()
+        self.assertEqual(InboxEntry.rebuild(), 4)
+        self.assertEqual(self.user0.actions.feed().count(), 2)
+
+
+class HybridInboxTests(InboxTests):
+
+    @classmethod
+    def setUpClass(cls):
+        super(HybridInboxTests, cls).setUpClass()
+        models.INBOX_MAX_TRACKERS = 1
+
+    @classmethod
+    def tearDownClass(cls):
+        models.INBOX_MAX_TRACKERS = None
+        super(HybridInboxTests, cls).tearDownClass()
+
+    def test_crowded(self):
+        actrack.track(self.user0, self.project, actor_only=False)
+        self.log(self.user0, 'modified', targets=self.project, commit=True)
+        modified = Action.objects.get(verb='modified')
+
+        # the project is tracked by too many users for the action to be
+        # stored in the inboxes, it is retrieved when reading the feeds
+        self.assertFalse(modified.inbox_entries.exists())
+        self.assertIn(modified, self.user0.actions.feed())
+        self.assertIn(modified, self.user2.actions.feed())
+        self.assertEqual(self.user2.actions.feed().count(), 3)
+
+        # when the project is not crowded anymore, the action is added to
+        # the remaining inbox
+        actrack.untrack(self.user0, self.project)
+        self.assertSetEqual(set(e.user for e in modified.inbox_entries.all()),
+                            {self.user2})
+        self.assertEqual(self.user2.actions.feed().count(), 3)
+
+    def test_uncrowd_transition(self):
+        actrack.track(self.user0, self.project, actor_only=False)
+        actrack.track(self.user1, self.project, actor_only=False)
+        self.log(self.user0, 'modified', targets=self.project, commit=True)
+        modified = Action.objects.get(verb='modified')
+
+        models.INBOX_MAX_TRACKERS = 2
+        try:
+            # the project is still crowded
+            actrack.untrack(self.user0, self.task1)
+            self.assertFalse(modified.inbox_entries.exists())
+
+            # the remaining trackers are backfilled in one query
+            with CaptureQueriesContext(connection) as ctx:
+                actrack.untrack(self.user0, self.project)
+            self.assertEqual(len([q for q in ctx.captured_queries
+                                  if q['sql'].startswith('INSERT')]), 1)
+            self.assertSetEqual(
+                set(e.user for e in modified.inbox_entries.all()),
+                {self.user1, self.user2}
+            )
+
+            # the project was not crowded already
+            with CaptureQueriesContext(connection) as ctx:
+                actrack.untrack(self.user0, self.project)
+            self.assertFalse([q for q in ctx.captured_queries
+                              if q['sql'].startswith('INSERT')])
+        finally:
+            models.INBOX_MAX_TRACKERS = 1
+
+    def test_crowded_many_objects(self):
+        Task.objects.bulk_create([Task(project=self.project)
+                                  for __ in range(1100)])
+        for task in Task.objects.all():
+            self.log(self.user1, 'created', targets=task, grouping_delay=-1)
+
+        # the crowded objects are looked up in a query which size does not
+        # depend on the number of objects
+        self.save_queue()
+        self.assertEqual(self.user0.actions.feed().count(), 1105)
+
 
 class TrackerManagerTests(ManagerTests):
 
@@ -0,0 +1,116 @@
+"""
+Saves the actions queue when the transaction in which actions are logged
+commits
+"""
+
+from django.core.signals import request_finished
+from django.db import transaction
+
+from ._base import TransactionTestCase
+
+from actrack import actions_queue
+from actrack.gfk import get_content_type
+from actrack.models import Action, DeletedItem
+
+from .app.models import Project, Task
+
+
+class TransactionTests(TransactionTestCase):
+
+    def setUp(self):
+        actions_queue.SAVE_ON_COMMIT = True
+        self.user = self.user_model.objects.create(username='user')
+        self.project = Project.objects.create()
+
+    def tearDown(self):
+        actions_queue.SAVE_ON_COMMIT = False
+
+    def test_commit(self):
+        with transaction.atomic():
+            self.log(self.user, 'tests', related=self.project)
+            self.log(self.user, 'tests2', related=self.project)
+            self.assertEqual(Action.objects.count(), 0)
+
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                self.log(self.user, 'tests', related=self.project)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        request_finished.send(None)
+
+        self.assertEqual(Action.objects.count(), 0)
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+    def test_no_transaction(self):
+        self.log(self.user, 'tests', related=self.project)
+        request_finished.send(None)
+
+        self.assertEqual(Action.objects.count(), 1)
+
+    def test_autocommit_then_rollback(self):
+        self.log(self.user, 'tests', related=self.project)
+        try:
+            with transaction.atomic():
+                self.log(self.user, 'tests2', related=self.project)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        request_finished.send(None)
+
+        # only the action logged in the rolled back transaction is discarded
+        self.assertListEqual(list(Action.objects.values_list('verb',
+                                                             flat=True)),
+                             ['tests'])
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+    def test_savepoint_rollback(self):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.log(self.user, 'tests', related=self.project)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            self.log(self.user, 'tests2', related=self.project)
+            with transaction.atomic():
+                self.log(self.user, 'tests3', related=self.project)
+            self.assertEqual(Action.objects.count(), 0)
+
+        # the actions logged in the outer transaction and in the committed
+        # savepoint are saved, not the one logged in the rolled back savepoint
+        self.assertSetEqual(set(Action.objects.values_list('verb',
+                                                           flat=True)),
+                            {'tests2', 'tests3'})
+        self.assertEqual(len(actions_queue.thread_actions_queue), 0)
+
+    def test_pending_transaction(self):
+        self.log(self.user, 'tests', related=self.project)
+        with transaction.atomic():
+            self.log(self.user, 'tests2', related=self.project)
+            request_finished.send(None)
+            # the queue is saved when the transaction commits
+            self.assertEqual(Action.objects.count(), 0)
+
+        self.assertEqual(Action.objects.count(), 2)
+
+    def test_pending_transaction_deleted_target(self):
+        task = Task.objects.create(project=self.project)
+        self.log(self.user, 'tests', related=self.project)
+        with transaction.atomic():
+            self.log(self.user, 'tests2', targets=task)
+            task.delete()
+            # the deleted items registry is flushed when the first action is
+            # saved, the held action must still find the task's deleted item
+            actions_queue.thread_actions_queue.save()
+            self.assertEqual(Action.objects.count(), 1)
+
+        self.assertEqual(Action.objects.filter(
+            verb='tests2', action_targets__gm2m_ct=get_content_type(DeletedItem)
+        ).count(), 1)
@@ -1,8 +1,13 @@
 import time
 from datetime import timedelta
+from io import StringIO
 
-from actrack import track
-from actrack.models import Action, Tracker, TempTracker, now
+from django.core.management import call_command
+from django.core.signals import request_started, request_finished
+
+from actrack import track, models
+from actrack.settings import LEVELS
+from actrack.models import Action, Tracker, TempTracker, UnreadTracker, now
 from actrack.gfk import get_content_type
 
 from ._base import TestCase
@@ -31,6 +36,29 @@ class UnreadTests(TestCase):
         self.assertTrue(action.is_unread_for(self.user0))
         self.assertFalse(action.is_unread_for(self.user1))
 
+    def test_is_unread_for_cache(self):
+        action = self.user0.actions.feed()[0]
+        self.user0.unread_actions  # retrieves the unread tracker
+
+        # one query per call outside of requests
+        with self.assertNumQueries(1):
+            self.assertTrue(action.is_unread_for(self.user0))
+
+        request_started.send(None)
+        try:
+            self.assertTrue(action.is_unread_for(self.user0))
+            with self.assertNumQueries(0):
+                self.assertTrue(action.is_unread_for(self.user0))
+
+            # the cache is updated when the action is marked as read
+            action.mark_read_for(self.user0)
+            with self.assertNumQueries(0):
+                self.assertFalse(action.is_unread_for(self.user0))
+        finally:
+            request_finished.send(None)
+
+        self.assertIsNone(UnreadTracker.cache.states)
+
     def test_mark_read_for(self):
         action = self.user0.actions.feed()[0]
         action.mark_read_for(self.user0)
@@ -55,6 +83,28 @@ class UnreadTests(TestCase):
             [False, False]
         )
 
+    def test_bulk_queries(self):
+        actions = list(self.user0.actions.feed())
+        self.user0.unread_actions  # retrieves the unread tracker
+
+        with self.assertNumQueries(1):
+            self.assertListEqual(
+                Action.bulk_is_unread_for(self.user0, actions), [True, True]
+            )
+
+        # one query to retrieve the unread actions, one to delete them and one
+        # to update the unread count in a savepoint
+        with self.assertNumQueries(5):
+            self.assertListEqual(
+                Action.bulk_mark_read_for(self.user0, actions), [True, True]
+            )
+
+        # no deletion if no action was unread
+        with self.assertNumQueries(1):
+            self.assertListEqual(
+                Action.bulk_mark_read_for(self.user0, actions), [False, False]
+            )
+
     def test_bulk_render(self):
         # as AUTO_READ setting is true, rendering actions marks them as read
         # automatically
@@ -65,6 +115,221 @@ class UnreadTests(TestCase):
         )
 
 
+class UnreadCountTests(TestCase):
+
+    def setUp(self):
+        self.user0 = self.user_model.objects.create(username='user0')
+        self.user1 = self.user_model.objects.create(username='user1')
+
+        track(self.user0, self.user1, actor_only=True)
+
+        for verb in ('created', 'modified', 'validated'):
+            self.log(self.user1, verb)
+        self.save_queue()
+
+        self.actions = list(self.user0.actions.feed())
+
+    def get_count(self):
+        return UnreadTracker.objects.get(user=self.user0).unread_count
+
+    def test_count(self):
+        self.assertEqual(self.user0.unread_actions.count(), 3)
+        self.assertEqual(self.get_count(), 3)
+
+    def test_mark_read(self):
+        self.actions[0].mark_read_for(self.user0)
+        self.assertEqual(self.user0.unread_actions.count(), 2)
+
+        # already read
+        self.actions[0].mark_read_for(self.user0)
+        self.assertEqual(self.get_count(), 2)
+
+        Action.bulk_mark_read_for(self.user0, self.actions)
+        self.assertEqual(self.user0.unread_actions.count(), 0)
+        self.assertEqual(self.get_count(), 0)
+
+    def test_mark_unread(self):
+        Action.bulk_mark_read_for(self.user0, self.actions)
+
+        # already unread actions are not counted twice
+        self.user0.unread_actions.mark_unread(*self.actions[:2])
+        self.user0.unread_actions.mark_unread(*self.actions)
+        self.assertEqual(self.user0.unread_actions.count(), 3)
+        self.assertEqual(self.get_count(), 3)
+
+    def test_repair(self):
+        unread_tracker = self.user0.unread_actions
+        unread_tracker.unread_actions.remove(self.actions[0])
+        self.assertEqual(self.get_count(), 3)
+
+        out = StringIO()
+        call_command('actrack_repair_unread', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '1 unread count(s) repaired')
+        self.assertEqual(self.get_count(), 2)
+
+
+class WatermarkTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(WatermarkTests, cls).setUpClass()
+        models.UNREAD_WATERMARK = True
+
+    @classmethod
+    def tearDownClass(cls):
+        models.UNREAD_WATERMARK = False
+        super(WatermarkTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.user0 = self.user_model.objects.create(username='user0')
+        self.user1 = self.user_model.objects.create(username='user1')
+        self.unread_tracker = self.user0.unread_actions
+        self.unread_tracker.watermark  # initializes the watermark
+        time.sleep(0.001)
+
+        track(self.user0, self.user1, actor_only=True)
+
+        for verb in ('created', 'modified', 'validated'):
+            self.log(self.user1, verb)
+        self.save_queue()
+
+        self.actions = list(self.user0.actions.feed())
+
+    def assertUnread(self, unread):
+        self.assertListEqual(
+            Action.bulk_is_unread_for(self.user0, self.actions), unread
+        )
+        self.assertListEqual(
+            [a.is_unread_for(self.user0) for a in self.actions], unread
+        )
+        self.assertEqual(self.unread_tracker.count(), unread.count(True))
+        self.assertEqual(
+            UnreadTracker.objects.get(pk=self.unread_tracker.pk).unread_count,
+            unread.count(True)
+        )
+
+    def test_no_rows(self):
+        self.assertUnread([True, True, True])
+        self.assertEqual(self.unread_tracker.unread_actions.count(), 0)
+        self.assertSetEqual(set(self.unread_tracker.all()), set(self.actions))
+
+    def test_mark_read(self):
+        self.actions[0].mark_read_for(self.user0)
+        self.assertUnread([False, True, True])
+        self.assertListEqual(list(self.unread_tracker.read_actions.all()),
+                             [self.actions[0]])
+
+        self.unread_tracker.mark_unread(self.actions[0])
+        self.assertUnread([True, True, True])
+        self.assertEqual(self.unread_tracker.read_actions.count(), 0)
+
+    def test_mark_unread(self):
+        self.actions[0].mark_read_for(self.user0)
+
+        # already unread actions are not counted twice
+        self.unread_tracker.mark_unread(self.actions[1])
+        self.assertUnread([False, True, True])
+        self.unread_tracker.mark_unread(*self.actions)
+        self.assertUnread([True, True, True])
+
+    def test_mark_all_read(self):
+        self.actions[0].mark_read_for(self.user0)
+
+        with self.assertNumQueries(5):
+            self.unread_tracker.mark_all_read()
+
+        self.assertUnread([False, False, False])
+        self.assertEqual(self.unread_tracker.read_actions.count(), 0)
+
+        # older actions can still be marked as unread
+        self.unread_tracker.mark_unread(self.actions[1])
+        self.assertUnread([False, True, False])
+        self.assertSetEqual(set(self.unread_tracker.all()), {self.actions[1]})
+
+    def test_repair(self):
+        UnreadTracker.objects.update(unread_count=0)
+        self.assertEqual(UnreadTracker.repair_counts(), 1)
+        self.assertEqual(
+            UnreadTracker.objects.get(pk=self.unread_tracker.pk).unread_count,
+            3
+        )
+
+
+class FanOutTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(FanOutTests, cls).setUpClass()
+        models.UNREAD_FANOUT = True
+
+    @classmethod
+    def tearDownClass(cls):
+        models.UNREAD_FANOUT = False
+        super(FanOutTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.user0 = self.user_model.objects.create(username='user0')
+        self.user1 = self.user_model.objects.create(username='user1')
+        self.user2 = self.user_model.objects.create(username='user2')
+
+        self.project = Project.objects.create(name='project')
+        self.task = Task.objects.create(project=self.project, name='task')
+
+        track(self.user0, self.user1, actor_only=True)
+        track(self.user2, self.project, actor_only=False, verbs=['created'])
+        track(self.user2, self.task, actor_only=False)
+
+    def test_fan_out(self):
+        self.log(self.user1, 'created', targets=self.task,
+                 related=self.project)
+        self.log(self.user1, 'modified', targets=self.project)
+        self.log(self.user1, 'debugged', targets=self.task,
+                 level=LEVELS['DEBUG'])
+        self.save_queue()
+
+        created, modified = [Action.objects.get(verb=verb)
+                             for verb in ('created', 'modified')]
+
+        # the actions are marked as unread when they are saved
+        self.assertSetEqual(set(self.user0.unread_actions.all()),
+                            {created, modified})
+        self.assertEqual(self.user0.unread_actions.count(), 2)
+
+        # only the tracked verbs are taken into account for the project, and
+        # the action is marked as unread only once for user2
+        self.assertSetEqual(set(self.user2.unread_actions.all()), {created})
+        self.assertEqual(self.user2.unread_actions.count(), 1)
+
+        self.assertEqual(self.user1.unread_actions.count(), 0)
+
+        # the feed does not mark the actions as unread again
+        created.mark_read_for(self.user0)
+        self.assertEqual(len(self.user0.actions.feed()), 2)
+        self.assertSetEqual(set(self.user0.unread_actions.all()), {modified})
+        self.assertEqual(self.user0.unread_actions.count(), 1)
+
+    def test_fan_out_grouped(self):
+        user3 = self.user_model.objects.create(username='user3')
+        track(user3, self.task, actor_only=False)
+        self.log(self.user1, 'created', targets=self.project, commit=True)
+        action = Action.objects.get()
+        action.mark_read_for(self.user0)
+
+        # the task is added to the saved action by grouping
+        self.log(self.user1, 'created', targets=self.task, grouping_delay=60,
+                 commit=True)
+        self.assertSetEqual(set(action.targets.all()),
+                            {self.project, self.task})
+
+        # the action is unread for the new tracker only, the users who
+        # already tracked it are left as they were
+        self.assertSetEqual(set(user3.unread_actions.all()), {action})
+        self.assertEqual(user3.unread_actions.count(), 1)
+        self.assertEqual(self.user0.unread_actions.count(), 0)
+        self.assertSetEqual(set(self.user2.unread_actions.all()), {action})
+        self.assertEqual(self.user2.unread_actions.count(), 1)
+
+
 class MultipleUnreadTests(TestCase):
     """
     Tests to make sure that actions are not marked as unread multiple times
@@ -106,6 +371,147 @@ class MultipleUnreadTests(TestCase):
         # already been fetched through the first tracker
         self.assertFalse(action.is_unread_for(self.user1))
 
+    def test_matching_queries(self):
+        for verb in ('modified', 'validated', 'closed'):
+            self.log(self.user0, verb, targets=self.task)
+        self.save_queue()
+        self.user1.unread_actions  # retrieves the unread tracker
+
+        # the tracker for the project has fetched the first action
+        t_proj = Tracker.objects.get(tracked_ct=get_content_type(Project))
+        t_proj.last_updated = now()
+        t_proj.save()
+
+        # the number of queries does not depend on the number of actions and
+        # trackers: the new actions probe, the user, the actions, the
+        # actions fetched elsewhere, the other trackers, the participants (2),
+        # the unread tracker, the unread marking (5), the tracker update and
+        # fetched elsewhere clear
+        t_task = Tracker.objects.get(tracked_ct=get_content_type(Task))
+        with self.assertNumQueries(15):
+            last_actions = t_task.update_unread()
+
+        self.assertEqual(len(last_actions), 3)
+
+    def test_bulk_update_unread(self):
+        action = Action.objects.all()[0]
+        trackers = list(Tracker.objects.all())
+        self.user1.unread_actions  # creates the unread tracker
+
+        # one query for the actions, one for the actions fetched elsewhere,
+        # two for the participants, the unread marking (5), one update and
+        # one delete for all the trackers
+        with self.assertNumQueries(11):
+            new_actions = Tracker.bulk_update_unread(self.user1, trackers)
+
+        self.assertSetEqual(new_actions, {action})
+        self.assertTrue(action.is_unread_for(self.user1))
+        self.assertEqual(self.user1.unread_actions.count(), 1)
+        self.assertEqual(
+            len({t.last_updated for t in Tracker.objects.all()}), 1
+        )
+
+        # the action is not marked as unread twice
+        action.mark_read_for(self.user1)
+        self.assertSetEqual(
+            Tracker.bulk_update_unread(self.user1, Tracker.objects.all()),
+            set()
+        )
+        self.assertFalse(action.is_unread_for(self.user1))
+
+    def test_bulk_update_unread_many_trackers(self):
+        action = Action.objects.all()[0]
+        project_ct = get_content_type(Project)
+        Tracker.objects.bulk_create([
+            Tracker(user=self.user1, tracked_ct=project_ct,
+                    tracked_pk=str(pk), actor_only=False,
+                    last_updated=now() - timedelta(1))
+            for pk in range(1000, 3000)
+        ])
+        self.user1.unread_actions  # creates the unread tracker
+
+        # the size of the query does not depend on the number of trackers
+        self.assertSetEqual(
+            Tracker.bulk_update_unread(self.user1, Tracker.objects.all()),
+            {action}
+        )
+
+    def test_update_unread_probe(self):
+        Tracker.bulk_update_unread(self.user1, Tracker.objects.all())
+
+        # an action on an object that is not tracked
+        project2 = Project.objects.create(name='project2')
+        self.log(self.user0, 'created', targets=project2, commit=True)
+
+        # no new action on the tracked objects, one query looks for them and
+        # another one marks the trackers as updated
+        trackers = list(Tracker.objects.all())
+        with self.assertNumQueries(2):
+            self.assertSetEqual(
+                Tracker.bulk_update_unread(self.user1, trackers), set()
+            )
+        with self.assertNumQueries(2):
+            self.assertSetEqual(trackers[0].update_unread(), set())
+
+    def test_update_unread_interval(self):
+        models.UNREAD_REFRESH_INTERVAL = 60
+        try:
+            trackers = list(Tracker.objects.all())
+            with self.assertNumQueries(0):
+                self.assertSetEqual(
+                    Tracker.bulk_update_unread(self.user1, trackers), set()
+                )
+                self.assertSetEqual(trackers[0].update_unread(), set())
+
+            # the refresh occurs once the interval has elapsed
+            Tracker.objects.update(last_updated=now() - timedelta(0, 61))
+            self.assertEqual(
+                len(Tracker.bulk_update_unread(self.user1,
+                                               Tracker.objects.all())),
+                1
+            )
+        finally:
+            models.UNREAD_REFRESH_INTERVAL = 0
+
+    def test_update_unread_idle_interval(self):
+        # the trackers have not been updated for more than the interval, and
+        # no action has occurred since
+        Action.objects.update(timestamp=now() - timedelta(0, 120))
+        Tracker.objects.update(last_updated=now() - timedelta(0, 61))
+
+        models.UNREAD_REFRESH_INTERVAL = 60
+        try:
+            # no action since the trackers were updated, the next polls are
+            # throttled all the same
+            trackers = list(Tracker.objects.all())
+            with self.assertNumQueries(2):
+                Tracker.bulk_update_unread(self.user1, trackers)
+            with self.assertNumQueries(0):
+                Tracker.bulk_update_unread(self.user1, trackers)
+
+            Tracker.objects.update(last_updated=now() - timedelta(0, 61))
+            tracker = Tracker.objects.all()[0]
+            with self.assertNumQueries(2):
+                self.assertSetEqual(tracker.update_unread(), set())
+            with self.assertNumQueries(0):
+                self.assertSetEqual(tracker.update_unread(), set())
+        finally:
+            models.UNREAD_REFRESH_INTERVAL = 0
+
+    def test_bulk_update_unread_fetched(self):
+        action = Action.objects.all()[0]
+
+        # the action has already been fetched by the project tracker
+        t_proj = Tracker.objects.get(tracked_ct=get_content_type(Project))
+        t_proj.update_unread()
+        action.mark_read_for(self.user1)
+
+        self.assertSetEqual(
+            Tracker.bulk_update_unread(self.user1, Tracker.objects.all()),
+            set()
+        )
+        self.assertFalse(action.is_unread_for(self.user1))
+
     def test_temp_tracker(self):
         """
         Same as above but with a temporary tracker